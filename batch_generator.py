@@ -0,0 +1,133 @@
+import numpy as np
+
+from model import *
+
+# out-degree limits up to this value are sampled per node without a dense n x n matrix
+SPARSE_MAX_DEGREE = 16
+# entries of the acceptance matrix that the dense sampling holds at once
+DENSE_BLOCK_ENTRIES = 1 << 20
+
+
+def _sample_limited_out_edges(rng, num_instances: int, num_nodes: int, prob_edge: float,
+                              max_outgoing_edges: int):
+    """
+        Every node accepts each other node with probability prob_edge and keeps max_outgoing_edges of the accepted
+        ones, chosen uniformly. The number of accepted nodes is binomial, so only the kept targets are drawn.
+    """
+    k = min(max_outgoing_edges, num_nodes - 1)
+    nodes = np.arange(num_nodes)[np.newaxis, :, np.newaxis]
+    kept = np.minimum(rng.binomial(num_nodes - 1, prob_edge, size=(num_instances, num_nodes)), k)
+    valid = np.arange(k) < kept[..., np.newaxis]
+
+    targets = rng.integers(0, num_nodes - 1, size=(num_instances, num_nodes, k))
+    targets += targets >= nodes
+
+    # draw the targets that repeat an earlier target of the same node again
+    earlier = np.tril(np.ones((k, k), dtype=bool), -1)
+    while True:
+        same = targets[..., :, np.newaxis] == targets[..., np.newaxis, :]
+        duplicate = (same & earlier & valid[..., np.newaxis, :]).any(axis=-1) & valid
+        if not duplicate.any():
+            break
+        redrawn = rng.integers(0, num_nodes - 1, size=int(duplicate.sum()))
+        targets[duplicate] = redrawn + (redrawn >= np.nonzero(duplicate)[1])
+
+    instance, node, position = np.nonzero(valid)
+    return instance, node, targets[instance, node, position]
+
+
+def _sample_dense_out_edges(rng, num_instances: int, num_nodes: int, prob_edge: float, max_outgoing_edges):
+    """
+        Accepts every pair with probability prob_edge and keeps max_outgoing_edges of the accepted out-edges of
+        every node, chosen uniformly. The acceptance matrix is sampled in blocks of source nodes of at most about
+        DENSE_BLOCK_ENTRIES entries, never for the whole batch at once.
+    """
+    rows_per_block = max(1, DENSE_BLOCK_ENTRIES // (num_instances * num_nodes))
+    limit = max_outgoing_edges is not None and max_outgoing_edges < num_nodes - 1
+    blocks = []
+    for first in range(0, num_nodes, rows_per_block):
+        rows = np.arange(first, min(first + rows_per_block, num_nodes))
+        accepted = rng.random((num_instances, len(rows), num_nodes)) < prob_edge
+        accepted[:, np.arange(len(rows)), rows] = False
+        if limit:
+            priority = np.where(accepted, rng.random(accepted.shape), np.inf)
+            kept = np.zeros_like(accepted)
+            lowest = np.argpartition(priority, max_outgoing_edges - 1, axis=-1)[..., :max_outgoing_edges]
+            np.put_along_axis(kept, lowest, True, axis=-1)
+            accepted &= kept
+
+        instance, node, target = np.nonzero(accepted)
+        blocks.append((instance, node + first, target))
+    return tuple(np.concatenate(column) for column in zip(*blocks))
+
+
+def _limit_in_edges(rng, instance, node, target, max_incoming_edges: int):
+    """ Keeps max_incoming_edges of the edges into every node, chosen uniformly """
+    order = np.lexsort((rng.random(len(target)), target, instance))
+    instance, node, target = instance[order], node[order], target[order]
+
+    group_start = np.ones(len(target), dtype=bool)
+    group_start[1:] = (instance[1:] != instance[:-1]) | (target[1:] != target[:-1])
+    start_index = np.maximum.accumulate(np.where(group_start, np.arange(len(target)), 0))
+    keep = np.arange(len(target)) - start_index < max_incoming_edges
+    return instance[keep], node[keep], target[keep]
+
+
+def build_random_DAGs(num_instances: int, num_nodes: int, prob_edge: float, arbitrary_demands=False,
+                      max_incoming_edges=DEFAULT_MAX_INCOMING_EDGES, max_outgoing_edges=DEFAULT_MAX_OUTGOING_EDGES,
+                      rng=None):
+    """
+        Samples a batch of random instances on the same number of nodes at once with NumPy. Like build_random_DAG,
+        every ordered pair of nodes is an edge with probability prob_edge, subject to the degree limits
+        (None for no limit), the target is node 0 and 2 to num_nodes - 2 of the nodes 1, ..., num_nodes - 2
+        are sources. The degree limits are enforced by dropping uniformly chosen edges instead of in the order
+        of the pairs, so the instances follow a slightly different distribution than build_random_DAG.
+
+        Parameters:
+                num_instances (int): The size of the batch
+                num_nodes (int): The number of nodes of every instance, at least 4
+                prob_edge (float): The probability of every edge
+                arbitrary_demands (bool): Random demands from 1 to num_nodes instead of unit demands
+                max_incoming_edges (int | None): The in-degree limit
+                max_outgoing_edges (int | None): The out-degree limit
+                rng (numpy.random.Generator | None): The source of randomness
+
+        Returns:
+                The list of instances
+    """
+    if num_nodes < 4:
+        raise RuntimeError("Random instances need at least 4 nodes.")
+    rng = rng if rng is not None else np.random.default_rng()
+
+    if max_outgoing_edges is not None and max_outgoing_edges <= SPARSE_MAX_DEGREE:
+        instance, node, target = _sample_limited_out_edges(rng, num_instances, num_nodes, prob_edge,
+                                                           max_outgoing_edges)
+    else:
+        instance, node, target = _sample_dense_out_edges(rng, num_instances, num_nodes, prob_edge,
+                                                         max_outgoing_edges)
+
+    if max_incoming_edges is not None:
+        instance, node, target = _limit_in_edges(rng, instance, node, target, max_incoming_edges)
+
+    # neighbors in ascending order, as in build_random_DAG
+    order = np.lexsort((target, node, instance))
+    instance, node, target = instance[order], node[order], target[order]
+    bounds = np.searchsorted(instance, np.arange(num_instances + 1))
+
+    num_sources = rng.integers(2, num_nodes - 1, size=num_instances)
+    candidates = np.argsort(rng.random((num_instances, num_nodes - 2)), axis=1) + 1
+
+    instances = []
+    for i in range(num_instances):
+        edges = defaultdict(list)
+        for start, end in zip(node[bounds[i]:bounds[i + 1]].tolist(), target[bounds[i]:bounds[i + 1]].tolist()):
+            edges[start].append(end)
+
+        sources = candidates[i, :num_sources[i]].tolist()
+        if arbitrary_demands:
+            demands = rng.integers(1, num_nodes + 1, size=len(sources)).tolist()
+        else:
+            demands = [1] * len(sources)
+        instances.append(Instance(DAG(num_nodes, edges), sources, 0, demands))
+
+    return instances
@@ -0,0 +1,269 @@
+import argparse
+import copy
+import itertools
+import json
+import platform
+import statistics
+
+import numpy as np
+
+from model import *
+from optimal_solver import calculate_optimal_solution, remove_cycles, PATH_FORMULATION, ARC_FORMULATION, \
+    CROSS_CHECK_FORMULATIONS
+from lp_backends import DEFAULT_BACKEND, BACKENDS
+from ecmp import iterate_sub_DAG, get_ecmp_DAG, get_ALL_optimal_ECMP_sub_DAGs, count_sub_DAGs, \
+    count_effective_sub_DAGs
+from conjectures import MetricsContext, MAIN_CONJECTURE, LOADS_CONJECTURE, EDGE_LOAD_CONJECTURE
+
+BenchmarkCase = namedtuple("BenchmarkCase", "num_nodes, prob_edge, arbitrary_demands")
+
+DEFAULT_CASES = [
+    BenchmarkCase(8, 0.3, False),
+    BenchmarkCase(8, 0.3, True),
+    BenchmarkCase(12, 0.3, True),
+    BenchmarkCase(12, 0.6, True),
+    BenchmarkCase(16, 0.4, True),
+]
+
+DEFAULT_CONJECTURES = [
+    MAIN_CONJECTURE,
+    LOADS_CONJECTURE,
+    EDGE_LOAD_CONJECTURE,
+    LOADS_CONJECTURE.implies(MAIN_CONJECTURE),
+]
+
+DEFAULT_RESULTS_PATH = "output/benchmark.json"
+
+# a stage counts as regressed if its median is this much slower than in the baseline
+REGRESSION_TOLERANCE = 0.25
+# and at least this much slower in seconds, below that timer noise dominates
+REGRESSION_MIN_DIFFERENCE = 1e-4
+
+# sub-DAGs per instance evaluated in the enumeration stage, the number of sub-DAGs grows exponentially
+MAX_SUB_DAGS = 2000
+
+
+def case_name(case: BenchmarkCase) -> str:
+    return f"n{case.num_nodes}_p{case.prob_edge}_{'arbitrary' if case.arbitrary_demands else 'unit'}"
+
+
+def _time_stage(function, *parameters, repeats=1):
+    """
+        Returns:
+                The fastest of repeats runs in seconds and the result of the last run
+    """
+    best = float('inf')
+    res = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        res = function(*parameters)
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+
+def _enumerate_sub_DAGs(dag: DAG, inst: Instance, max_sub_DAGs: int):
+    num_sub_DAGs = 0
+    for sub_dag in itertools.islice(iterate_sub_DAG(dag, as_view=True, inst=inst), max_sub_DAGs):
+        get_ecmp_DAG(sub_dag, inst)
+        num_sub_DAGs += 1
+    return num_sub_DAGs
+
+
+def _summary(timings: list) -> dict:
+    if not timings:
+        return {"count": 0}
+    return {
+        "count": len(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.fmean(timings),
+        "min": min(timings),
+        "max": max(timings),
+        "total": sum(timings),
+    }
+
+
+def benchmark_case(case: BenchmarkCase, case_seed: int, num_instances=20, repeats=5, conjectures=None,
+                   formulation=ARC_FORMULATION, backend=DEFAULT_BACKEND, max_sub_DAGs=MAX_SUB_DAGS):
+    """
+        Times every stage of the pipeline on num_instances random instances of one case. Each stage of each
+        instance is run repeats times and only the fastest run counts.
+
+        Returns:
+                A dict with timing summaries per stage and the number of feasible instances and sub-DAGs
+    """
+    conjectures = DEFAULT_CONJECTURES if conjectures is None else conjectures
+    timings = defaultdict(list)
+    num_feasible = 0
+    num_sub_DAGs = 0
+    num_candidates = 0
+    num_effective = 0
+
+    for index in range(num_instances):
+        seed = int(np.random.SeedSequence(case_seed, spawn_key=(index,)).generate_state(1, np.uint64)[0])
+        duration, inst = _time_stage(
+            lambda: build_random_DAG(case.num_nodes, case.prob_edge, case.arbitrary_demands, random.Random(seed)),
+            repeats=repeats
+        )
+        timings["build_random_DAG"].append(duration)
+
+        duration, opt_solution = _time_stage(calculate_optimal_solution, inst, formulation, backend, repeats=repeats)
+        timings["calculate_optimal_solution"].append(duration)
+        if opt_solution is None:
+            continue
+        num_feasible += 1
+
+        # remove_cycles works in place, so it gets a fresh copy of the LP flow in every run
+        flow = calculate_optimal_solution(inst, formulation, backend, cancel_cycles=False).dag
+        timings["remove_cycles"].append(min(
+            _time_stage(remove_cycles, copy.deepcopy(flow))[0] for _ in range(repeats)
+        ))
+
+        duration, count = _time_stage(_enumerate_sub_DAGs, opt_solution.dag, inst, max_sub_DAGs, repeats=repeats)
+        timings["iterate_sub_DAG+get_ecmp_DAG"].append(duration)
+        num_sub_DAGs += count
+        num_candidates += count_sub_DAGs(opt_solution.dag)
+        num_effective += count_effective_sub_DAGs(opt_solution.dag, inst)
+
+        ecmp_solutions = get_ALL_optimal_ECMP_sub_DAGs(opt_solution.dag, inst)
+        for conj in conjectures:
+            # a fresh context per run, so every conjecture pays for the metrics it needs
+            duration, _ = _time_stage(
+                lambda: conj.verify(MetricsContext(opt_solution, ecmp_solutions, inst)), repeats=repeats
+            )
+            timings[f"conjecture:{conj.name}"].append(duration)
+
+    return {
+        "num_nodes": case.num_nodes,
+        "prob_edge": case.prob_edge,
+        "arbitrary_demands": case.arbitrary_demands,
+        "seed": case_seed,
+        "num_instances": num_instances,
+        "num_feasible": num_feasible,
+        "num_sub_DAGs": num_sub_DAGs,
+        "num_sub_DAG_candidates": num_candidates,
+        "num_effective_sub_DAG_candidates": num_effective,
+        "stages": {stage: _summary(values) for stage, values in timings.items()},
+    }
+
+
+def run_benchmark(cases=None, seed=0, num_instances=20, repeats=5, conjectures=None, formulation=ARC_FORMULATION,
+                  backend=DEFAULT_BACKEND, max_sub_DAGs=MAX_SUB_DAGS):
+    """
+        Parameters:
+                cases (list[BenchmarkCase] | None): node count, edge probability and demand mode of each case,
+                    DEFAULT_CASES if None
+                seed (int): root seed, the instances of a case only depend on it and the parameters of the case
+                num_instances (int): random instances per case
+                repeats (int): runs per stage and instance, the fastest one counts
+                conjectures (list[Conjecture] | None): the conjectures to time, DEFAULT_CONJECTURES if None
+                formulation, backend: passed to calculate_optimal_solution
+                max_sub_DAGs (int): sub-DAGs per instance evaluated in the enumeration stage
+
+        Returns:
+                The benchmark results as a JSON-serializable dict
+    """
+    cases = DEFAULT_CASES if cases is None else cases
+    results = {
+        "meta": {
+            "seed": seed,
+            "num_instances": num_instances,
+            "repeats": repeats,
+            "formulation": formulation,
+            "backend": backend,
+            "max_sub_DAGs": max_sub_DAGs,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created": time.time(),
+        },
+        "cases": {},
+    }
+
+    for case in cases:
+        case_key = (case.num_nodes, round(case.prob_edge * 10 ** 6), int(case.arbitrary_demands))
+        case_seed = int(np.random.SeedSequence(seed, spawn_key=case_key).generate_state(1, np.uint64)[0])
+        results["cases"][case_name(case)] = benchmark_case(
+            case, case_seed, num_instances, repeats, conjectures, formulation, backend, max_sub_DAGs
+        )
+
+    return results
+
+
+def save_results(results: dict, path=DEFAULT_RESULTS_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+Regression = namedtuple("Regression", "case, stage, baseline, current, ratio")
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance=REGRESSION_TOLERANCE,
+                        min_difference=REGRESSION_MIN_DIFFERENCE):
+    """
+        Compares the median time of every stage that appears in both results.
+
+        Returns:
+                The list of (case, stage, baseline median, current median, ratio) for all stages and the list of
+                regressions among them, whose ratio exceeds 1 + tolerance and that are min_difference seconds slower
+    """
+    comparisons = []
+    for name, case in results["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        baseline_stages = baseline["cases"][name]["stages"]
+        for stage, summary in case["stages"].items():
+            if summary["count"] == 0 or baseline_stages.get(stage, {}).get("count", 0) == 0:
+                continue
+            before, after = baseline_stages[stage]["median"], summary["median"]
+            ratio = after / before if before > 0 else float('inf')
+            comparisons.append(Regression(name, stage, before, after, ratio))
+
+    return comparisons, [
+        c for c in comparisons if c.ratio > 1 + tolerance and c.current - c.baseline > min_difference
+    ]
+
+
+def format_comparison(comparisons: list) -> str:
+    lines = [f"{'case':<22} {'stage':<42} {'baseline':>10} {'current':>10} {'ratio':>7}"]
+    for c in comparisons:
+        lines.append(f"{c.case:<22} {c.stage:<42} {c.baseline * 1000:>8.3f}ms {c.current * 1000:>8.3f}ms "
+                     f"{c.ratio:>6.2f}x")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the conjecture checking pipeline.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--instances", type=int, default=20, help="random instances per case")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per stage, the fastest one counts")
+    parser.add_argument("--output", default=DEFAULT_RESULTS_PATH, help="where to write the JSON results")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument("--formulation", default=ARC_FORMULATION,
+                        choices=[PATH_FORMULATION, ARC_FORMULATION, CROSS_CHECK_FORMULATIONS])
+    parser.add_argument("--backend", default=DEFAULT_BACKEND, choices=list(BACKENDS), help="the LP solver")
+    parser.add_argument("--conjectures", nargs="+", choices=[conj.name for conj in DEFAULT_CONJECTURES],
+                        help="the conjectures to time, all by default")
+    args = parser.parse_args()
+
+    selected = None
+    if args.conjectures:
+        selected = [conj for conj in DEFAULT_CONJECTURES if conj.name in args.conjectures]
+    benchmark_results = run_benchmark(seed=args.seed, num_instances=args.instances, repeats=args.repeats,
+                                      conjectures=selected, formulation=args.formulation, backend=args.backend)
+    save_results(benchmark_results, args.output)
+    print(f"Wrote {args.output}")
+
+    if args.baseline:
+        all_comparisons, regressions = compare_to_baseline(benchmark_results, load_results(args.baseline),
+                                                           args.tolerance)
+        print(format_comparison(all_comparisons))
+        if regressions:
+            print(f"{len(regressions)} stages are more than {args.tolerance:.0%} slower than the baseline:")
+            print(format_comparison(regressions))
+            sys.exit(1)
@@ -0,0 +1,80 @@
+import hashlib
+import itertools
+import math
+
+from model import *
+
+# isomorphism classes that leave more node orderings than this are hashed with their labels
+MAX_CANONICAL_PERMUTATIONS = 5040
+
+
+def _refine_colors(inst: Instance):
+    """
+        Color refinement (1-dim. Weisfeiler-Leman) on the instance graph. The initial color of a node is its role
+        (target, demand) and degree. Colors are ranks of sorted signatures, so they do not depend on the labels.
+    """
+    num_nodes = inst.dag.num_nodes
+    demand = [0] * num_nodes
+    for s, d in zip(inst.sources, inst.demands):
+        demand[s] += d
+
+    out_nbs = [list(inst.dag.neighbors[node]) for node in range(num_nodes)]
+    in_nbs = [[] for _ in range(num_nodes)]
+    for node in range(num_nodes):
+        for nb in out_nbs[node]:
+            in_nbs[nb].append(node)
+
+    signatures = [(node == inst.target, demand[node], len(out_nbs[node]), len(in_nbs[node]))
+                  for node in range(num_nodes)]
+    while True:
+        ranks = {sig: rank for rank, sig in enumerate(sorted(set(signatures)))}
+        colors = [ranks[sig] for sig in signatures]
+        signatures = [
+            (colors[node], tuple(sorted(colors[nb] for nb in out_nbs[node])),
+             tuple(sorted(colors[nb] for nb in in_nbs[node])))
+            for node in range(num_nodes)
+        ]
+        if len(set(signatures)) == len(ranks):
+            return colors
+
+
+def _encode(inst: Instance, label: list):
+    edges = sorted((label[node], label[nb]) for node in range(inst.dag.num_nodes) for nb in inst.dag.neighbors[node])
+    sources = sorted((label[s], d) for s, d in zip(inst.sources, inst.demands))
+    return inst.dag.num_nodes, label[inst.target], tuple(edges), tuple(sources)
+
+
+def canonical_form(inst: Instance, up_to_isomorphism=True):
+    """
+        Returns:
+                A hashable encoding of the graph structure, sources, demands and target of the instance.
+                With up_to_isomorphism, isomorphic instances have the same encoding as long as color refinement
+                leaves at most MAX_CANONICAL_PERMUTATIONS orderings to try, otherwise the node labels are kept.
+    """
+    identity = list(range(inst.dag.num_nodes))
+    if not up_to_isomorphism:
+        return _encode(inst, identity)
+
+    colors = _refine_colors(inst)
+    classes = defaultdict(list)
+    for node in identity:
+        classes[colors[node]].append(node)
+    classes = [classes[color] for color in sorted(classes)]
+
+    if math.prod(math.factorial(len(c)) for c in classes) > MAX_CANONICAL_PERMUTATIONS:
+        return _encode(inst, identity)
+
+    # the canonical form is the smallest encoding among all orderings that respect the colors
+    best = None
+    for orderings in itertools.product(*(itertools.permutations(c) for c in classes)):
+        label = [0] * inst.dag.num_nodes
+        for position, node in enumerate(itertools.chain.from_iterable(orderings)):
+            label[node] = position
+        encoding = _encode(inst, label)
+        if best is None or encoding < best:
+            best = encoding
+    return best
+
+
+def instance_hash(inst: Instance, up_to_isomorphism=True) -> str:
+    return hashlib.sha256(repr(canonical_form(inst, up_to_isomorphism)).encode()).hexdigest()
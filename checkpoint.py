@@ -0,0 +1,55 @@
+import multiprocessing
+import os
+import pickle
+import time
+from collections import namedtuple
+
+DEFAULT_CHECKPOINT_DIR = "output/checkpoints"
+DEFAULT_CHECKPOINT_INTERVAL = 60.0
+
+# generator: the instance generator with its seed position (next index, seen hashes, ...),
+# statistics: the SuiteStatistics of the completed instances,
+# pending: the (index, instance) tasks that were generated but not completed yet
+Checkpoint = namedtuple("Checkpoint", "generator, statistics, pending, updated")
+
+
+class Checkpointer:
+    """
+        Periodically saves the progress of a test campaign to <directory>/<name>.pickle, so an interrupted
+        campaign can be resumed exactly where it stopped. The name defaults to the name of the current process,
+        which gives every worker its own checkpoint.
+    """
+
+    def __init__(self, name=None, directory=DEFAULT_CHECKPOINT_DIR, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.name = name if name is not None else multiprocessing.current_process().name
+        self.directory = directory
+        self.interval = interval
+        self.last_save = time.time()
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"{self.name}.pickle")
+
+    def save(self, generator, statistics, pending=()):
+        checkpoint = Checkpoint(generator, statistics, list(pending), time.time())
+        os.makedirs(self.directory, exist_ok=True)
+        # write to a temporary file first, a kill during the write must not destroy the last checkpoint
+        with open(self.path + ".tmp", "wb") as f:
+            pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path + ".tmp", self.path)
+        self.last_save = time.time()
+
+    def maybe_save(self, generator, statistics, pending=()):
+        """ Saves the checkpoint if the last one is more than interval seconds old """
+        if time.time() - self.last_save >= self.interval:
+            self.save(generator, statistics, pending)
+
+    def load(self):
+        """
+            Returns:
+                    The saved Checkpoint or None if there is none
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as f:
+            return pickle.load(f)
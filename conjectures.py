@@ -1,77 +1,171 @@
 from model import *
+from output_writer import write_graph, write_pickle, write_text, unique_name
 
-import pickle
-import os
+import time
+from functools import cached_property
+
+
+class FlowMetrics:
+    """
+        Derived data of one flow, either the optimal Solution or an ECMP_Sol of an instance.
+        Every metric is computed on first access and then kept.
+    """
+
+    def __init__(self, solution, inst: Instance):
+        self.solution = solution
+        self.inst = inst
+
+    @property
+    def dag(self):
+        return self.solution.dag
+
+    @property
+    def congestion(self):
+        return self.solution.opt_congestion if isinstance(self.solution, Solution) else self.solution.congestion
+
+    @cached_property
+    def order(self):
+        return tuple(topologicalSort(self.dag))
+
+    @cached_property
+    def node_loads(self):
+        if isinstance(self.solution, ECMP_Sol):
+            return self.solution.loads
+        return get_node_loads(self.dag, self.inst)
+
+    @cached_property
+    def edge_loads(self):
+        return get_edge_loads(self.dag)
+
+    @cached_property
+    def num_edges(self):
+        return sum(len(self.dag.neighbors[node]) for node in range(self.dag.num_nodes))
+
+
+class MetricsContext:
+    """
+        Everything a conjecture gets to see about one instance: the optimal solution, the ECMP solutions to check
+        and their lazily computed metrics. The same context is handed to all conjectures (and both sides of an
+        implication), so each metric is computed at most once per candidate.
+
+        Parameters:
+                opt_solution (Solution): The optimal solution
+                ecmp_solutions (list[ECMP_Sol]): The ECMP solutions to check
+                inst (Instance): The routing instance
+                optimal (FlowMetrics | None): metrics of opt_solution to share with other contexts of the instance
+    """
+
+    def __init__(self, opt_solution: Solution, ecmp_solutions: list[ECMP_Sol], inst: Instance,
+                 optimal: FlowMetrics = None):
+        self.opt_solution = opt_solution
+        self.ecmp_solutions = ecmp_solutions
+        self.inst = inst
+        self.optimal = optimal if optimal is not None else FlowMetrics(opt_solution, inst)
+        self.ecmp = [FlowMetrics(sol, inst) for sol in ecmp_solutions]
+
+    @property
+    def order(self):
+        """ The topological order of the optimal flow, which is also one of every ECMP flow """
+        return self.optimal.order
+
+    @cached_property
+    def congestion_ratios(self):
+        return [ecmp.congestion / self.optimal.congestion for ecmp in self.ecmp]
 
 
 class Conjecture:
     VERBOSE = True
 
-    def __init__(self, name, verification_function, failure_message):
+    def __init__(self, name, verification_function, failure_message, render_ecmp_solutions=False):
         self.name = name
         self.verification_function = verification_function
         self.failure_message = failure_message
-
-    def check(self, opt_solution: Solution, ecmp_solutions: list[ECMP_Sol], inst: Instance, index: int):
-        success = self.verification_function(opt_solution, ecmp_solutions, inst)
+        # also render every ECMP solution of a counterexample on the optimal flow
+        self.render_ecmp_solutions = render_ecmp_solutions
+        self.calls = 0
+        self.total_time = 0.0
+
+    @property
+    def cost(self):
+        """ Measured average time of one verification, 0 until the conjecture was verified once """
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def verify(self, context: MetricsContext):
+        start = time.perf_counter()
+        success = self.verification_function(context)
+        self.total_time += time.perf_counter() - start
+        self.calls += 1
+        return success
+
+    def check(self, context: MetricsContext, index: int):
+        success = self.verify(context)
         if not success:
             # FAIL
             if Conjecture.VERBOSE:
-                self.print_failure(opt_solution, ecmp_solutions, inst, index)
+                self.print_failure(context, index)
             return False
 
         return True
 
-    def print_failure(self, opt_solution: Solution, ecmp_solutions: list[ECMP_Sol], inst: Instance, index: int):
+    def print_failure(self, context: MetricsContext, index: int):
+        inst = context.inst
         logger = get_logger()
         logger.error("")
         logger.error("=" * 40)
         logger.error(" " * 10 + "COUNTEREXAMPLE FOUND!!" + " " * 10)
         logger.error("=" * 40)
-        os.makedirs(f"output/errors_{self.name}", exist_ok=True)
-        with open(f"output/errors_{self.name}/ex_{index}.pickle", "wb") as f:
-            pickle.dump(inst, f, pickle.HIGHEST_PROTOCOL)
-            show_graph(inst, f"errors_{self.name}/ex_{index}", opt_solution.dag)
-
-        with open(f"output/errors_{self.name}/ex_{index}_fail.txt", "w") as f:
-            f.write(self.failure_message(opt_solution, ecmp_solutions, inst))
+        # the files are written by the background writer, see output_writer.py
+        name = unique_name(f"errors_{self.name}/ex_{index}")
+        # the instance and the failure text first, they matter more than the graphs
+        write_pickle(name, inst)
+        write_text(f"{name}_fail.txt", self.failure_message(context))
+        write_graph(inst, name, context.opt_solution.dag)
+        if self.render_ecmp_solutions:
+            trimmed_inst = Instance(context.opt_solution.dag, inst.sources, inst.target, inst.demands)
+            for i, ecmp_sol in enumerate(context.ecmp_solutions):
+                write_graph(trimmed_inst, f"{name}_ecmp_{i}", ecmp_sol.dag)
 
     def implies(self, other):
+        def verify_implication(context):
+            # holds if other holds or self fails, so evaluate the cheaper one first
+            if other.cost <= self.cost:
+                return other.verify(context) or not self.verify(context)
+            return not self.verify(context) or other.verify(context)
+
         return Conjecture(
             f"{self.name}_implies_{other.name}",
-            lambda opt_sol, ecmp_sols, inst: other.verification_function(opt_sol, ecmp_sols, inst) or (
-                not self.verification_function(opt_sol, ecmp_sols, inst)
-            ),
-            lambda opt_sol, ecmp_sols, inst: f"The implication {self.name} -> {other.name} failed.\n" +
-                                             self.failure_message(opt_sol, ecmp_sols, inst) + "\n" +
-                                             other.failure_message(opt_sol, ecmp_sols, inst)
+            verify_implication,
+            lambda context: f"The implication {self.name} -> {other.name} failed.\n" +
+                            self.failure_message(context) + "\n" +
+                            other.failure_message(context),
+            self.render_ecmp_solutions or other.render_ecmp_solutions
         )
 
 
 MAIN_CONJECTURE = Conjecture(
     "congestion",
-    lambda opt_sol, ecmp_sols, _: all(
-        ecmp_sols[i].congestion < 2 * opt_sol.opt_congestion for i in range(len(ecmp_sols))),
-    lambda opt_sol, ecmp_sols, _:
-    f"Optimal Congestion: {opt_sol.opt_congestion}\nBest ECMP Congestion: {min(ecmp.congestion for ecmp in ecmp_sols)}\n"
+    lambda context: all(ecmp.congestion < 2 * context.optimal.congestion for ecmp in context.ecmp),
+    lambda context:
+    f"Optimal Congestion: {context.optimal.congestion}\n"
+    f"Best ECMP Congestion: {min(ecmp.congestion for ecmp in context.ecmp)}\n"
+    f"Congestion Ratio: {max(context.congestion_ratios)}\n"
 )
 
 
-def check_loads(opt_solution: Solution, ecmp_solutions: list[ECMP_Sol], instance: Instance):
-    optimal_loads = get_node_loads(opt_solution.dag, instance)
+def check_loads(context: MetricsContext):
+    optimal_loads = context.optimal.node_loads
     return any([
-        compare_node_loads(ecmp_sol.loads, optimal_loads, instance.sources) is None
-        for ecmp_sol in ecmp_solutions
+        compare_node_loads(ecmp.node_loads, optimal_loads, context.inst.sources) is None
+        for ecmp in context.ecmp
     ])
 
 
-def loads_failed(opt_solution: Solution, ecmp_solutions: [ECMP_Sol], instance: Instance):
-    optimal_loads = get_node_loads(opt_solution.dag, instance)
+def loads_failed(context: MetricsContext):
+    ecmp_solutions, instance = context.ecmp_solutions, context.inst
+    optimal_loads = context.optimal.node_loads
 
     output = ""
     for i, ecmp_sol in enumerate(ecmp_solutions):
-        trimmed_inst = Instance(opt_solution.dag, instance.sources, instance.target, instance.demands)
-        show_graph(trimmed_inst, f"_THIS_{i}", ecmp_sol.dag)
         failed_node = compare_node_loads(ecmp_sol.loads, optimal_loads, instance.sources)
         output += f"Error in sub-DAG with index {i}:\n" \
                   f"Load at node {failed_node} too high:\n" \
@@ -86,46 +180,41 @@ def loads_failed(opt_solution: Solution, ecmp_solutions: [ECMP_Sol], instance: I
 LOADS_CONJECTURE = Conjecture(
     "node_loads",
     check_loads,
-    loads_failed
+    loads_failed,
+    render_ecmp_solutions=True
 )
 
 
-def check_same_edges(_, ecmp_sols: list[ECMP_Sol], __):
-    num_edges = sum([len(ecmp_sols[0].dag.neighbors[i]) for i in range(ecmp_sols[0].dag.num_nodes)])
-    return all([
-        sum([
-            len(sol.dag.neighbors[i]) for i in range(ecmp_sols[0].dag.num_nodes)
-        ]) == num_edges
-        for sol in ecmp_sols
-    ])
+def check_same_edges(context: MetricsContext):
+    num_edges = context.ecmp[0].num_edges
+    return all([ecmp.num_edges == num_edges for ecmp in context.ecmp])
 
 
 # !!!!!!!!!! PROVED WRONG !!!!!!!!!!
 SAME_NUMBER_OF_EDGES_CONJECTURE = Conjecture(
     "same_edges",
     check_same_edges,
-    lambda opt_sol, ecmp_sols, inst: f"Graph has {inst.dag.num_nodes} nodes\n" + "\n".join([str(
-        sum([len(sol.dag.neighbors[i]) for i in range(ecmp_sols[0].dag.num_nodes)])
-    ) for sol in ecmp_sols])
+    lambda context: f"Graph has {context.inst.dag.num_nodes} nodes\n" +
+                    "\n".join([str(ecmp.num_edges) for ecmp in context.ecmp])
 )
 # !!!!!!!!!! PROVED WRONG !!!!!!!!!!
 
 
+def _edge_loads_within(ecmp: FlowMetrics, optimal: FlowMetrics, strict=False):
+    # get() keeps the cached optimal edge loads free of zero entries
+    if strict:
+        return all(load < 2 * optimal.edge_loads.get(edge, 0) for edge, load in ecmp.edge_loads.items())
+    return all(load <= 2 * optimal.edge_loads.get(edge, 0) for edge, load in ecmp.edge_loads.items())
+
+
 EDGE_LOAD_CONJECTURE = Conjecture(
     "edge_loads",
-    lambda opt_sol, ecmp_sols, _: any(
-        all(get_edge_loads(ecmp.dag)[edge] <= 2 * get_edge_loads(opt_sol.dag)[edge] for edge in
-            get_edge_loads(ecmp.dag).keys()) for ecmp in
-        ecmp_sols
-    ),
-    lambda opt_sol, ecmp_sols, inst: f"Graph has {inst.dag.num_nodes} nodes.\n"
-                                     f"opt. edge loads: {get_edge_loads(opt_sol.dag)}\n" +
-                                     "\n".join(
-                                         f"ecmp edge loads: {get_edge_loads(ecmp.dag)}"
-                                         for ecmp in ecmp_sols
-                                         if not all(
-                                             get_edge_loads(ecmp.dag)[edge] < 2 * get_edge_loads(opt_sol.dag)[edge] for
-                                             edge in get_edge_loads(ecmp.dag).keys())
-                                     )
-
+    lambda context: any(_edge_loads_within(ecmp, context.optimal) for ecmp in context.ecmp),
+    lambda context: f"Graph has {context.inst.dag.num_nodes} nodes.\n"
+                    f"opt. edge loads: {context.optimal.edge_loads}\n" +
+                    "\n".join(
+                        f"ecmp edge loads: {ecmp.edge_loads}"
+                        for ecmp in context.ecmp
+                        if not _edge_loads_within(ecmp, context.optimal, strict=True)
+                    )
 )
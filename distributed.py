@@ -0,0 +1,356 @@
+import argparse
+import itertools
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client, answer_challenge, deliver_challenge
+
+from model import *
+from checkpoint import Checkpointer
+from output_writer import OutputWriter, write_pickle
+from stage_metrics import get_metrics
+from conjectures import MAIN_CONJECTURE, LOADS_CONJECTURE
+from main import ConjectureManager, InstanceGenerator, InstanceResult, SuiteStatistics, _generate_tasks, \
+    _verify_task, CHECK_ON_ALL_SUB_DAGS, ECMP_FORWARDING
+
+DEFAULT_PORT = 6001
+DEFAULT_HEARTBEAT_INTERVAL = 5.0
+DEFAULT_HEARTBEAT_TIMEOUT = 30.0
+DEFAULT_CONNECT_TIMEOUT = 30.0
+# how long a worker waits before asking again when all remaining instances are assigned to others
+IDLE_WAIT = 1.0
+
+# Messages are tuples whose first entry is the kind:
+# (HELLO, worker name, conjecture names), (REQUEST,), (RESULT, InstanceResult) and (HEARTBEAT,) from the worker,
+# (TASKS, [(index, instance), ...]) and (STOP, reason) from the coordinator.
+HELLO = "hello"
+REQUEST = "request"
+RESULT = "result"
+HEARTBEAT = "heartbeat"
+TASKS = "tasks"
+STOP = "stop"
+
+
+class Coordinator:
+    """
+        Hands out chunks of (index, instance) tasks over TCP to worker agents (see run_worker) and collects the
+        results. A worker asks for the next chunk once it finished the previous one and sends a heartbeat every few
+        seconds in between. A worker whose connection breaks or that is silent for heartbeat_timeout seconds is
+        dropped, the instances it had not finished go to the next worker that asks.
+        Messages are pickled, so the connections are authenticated with authkey (see multiprocessing.connection).
+        Every connection does its handshake on its own thread, a client that never answers only blocks itself.
+        Counterexamples are written to output/distributed, named after their index.
+    """
+
+    def __init__(self, generator: InstanceGenerator, num_instances: int, authkey: bytes,
+                 address=("localhost", DEFAULT_PORT), chunk_size=4, heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT,
+                 checkpoint: Checkpointer = None, resume=False):
+        self.generator = generator
+        self.num_instances = num_instances
+        self.authkey = authkey
+        self.address = address
+        self.chunk_size = chunk_size
+        self.heartbeat_timeout = heartbeat_timeout
+        self.checkpoint = checkpoint
+
+        self.statistics = SuiteStatistics()
+        # tasks of lost workers, handed out before new ones
+        self.requeued = deque()
+        saved = checkpoint.load() if checkpoint is not None and resume else None
+        if saved is not None:
+            self.generator, self.statistics = saved.generator, saved.statistics
+            self.requeued.extend(saved.pending)
+            get_logger().info(f"Resuming from {checkpoint.path} after {self.statistics.num_instances} instances")
+        num_new = max(num_instances - self.statistics.num_instances - len(self.requeued), 0)
+        self.tasks = _generate_tasks(self.generator, num_new)
+
+        # worker -> {index: instance} of the tasks it has not finished yet
+        self.assigned = dict()
+        self.num_connections = 0
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.listening = threading.Event()
+
+    def pending(self):
+        """ The generated tasks that are not finished yet, in index order """
+        tasks = list(self.requeued)
+        for worker_tasks in self.assigned.values():
+            tasks.extend(worker_tasks.items())
+        return sorted(tasks, key=lambda task: task[0])
+
+    def _next_chunk(self, worker: str):
+        chunk = []
+        while self.requeued and len(chunk) < self.chunk_size:
+            chunk.append(self.requeued.popleft())
+        chunk.extend(itertools.islice(self.tasks, self.chunk_size - len(chunk)))
+        self.assigned[worker].update(chunk)
+        return chunk
+
+    def _add_result(self, worker: str, result: InstanceResult):
+        logger = get_logger()
+        # results of tasks that were already handed to someone else do not count twice
+        if result.index not in self.assigned[worker]:
+            return
+        inst = self.assigned[worker].pop(result.index)
+        self.statistics.add(result)
+        self.generator.report(result.index, result.ratio)
+
+        if result.error is not None:
+            logger.error(f"{worker} failed on instance {result.index}: {result.error}")
+        elif not result.success:
+            write_pickle(f"distributed/ex_{result.index}", inst)
+            logger.error("=" * 50)
+            logger.error(f"  !!! {worker} FOUND A COUNTER EXAMPLE (instance {result.index}) !!!")
+            logger.error("=" * 50)
+            if ConjectureManager.exit_on_counterexample:
+                self.finished.set()
+
+        if self.statistics.num_instances >= self.num_instances:
+            self.finished.set()
+        if self.checkpoint is not None:
+            self.checkpoint.maybe_save(self.generator, self.statistics, self.pending())
+
+    def _drop(self, worker: str, reason: str):
+        lost = self.assigned.pop(worker)
+        self.requeued.extend(sorted(lost.items(), key=lambda task: task[0]))
+        get_logger().warning(f"Lost {worker} ({reason}), {len(lost)} of its instances are handed out again")
+
+    def _authenticate(self, conn):
+        """ The challenge of multiprocessing.connection, shut down if it takes longer than heartbeat_timeout """
+        timer = threading.Timer(self.heartbeat_timeout, _shutdown, (conn,))
+        timer.daemon = True
+        timer.start()
+        try:
+            deliver_challenge(conn, self.authkey)
+            answer_challenge(conn, self.authkey)
+            return True
+        except AuthenticationError:
+            get_logger().warning("Rejected a connection with a wrong authkey")
+            return False
+        finally:
+            timer.cancel()
+
+    def _serve(self, conn):
+        logger = get_logger()
+        reason = "finished"
+        worker = None
+        try:
+            if not self._authenticate(conn) or not conn.poll(self.heartbeat_timeout):
+                return
+            kind, name, conjectures = conn.recv()
+            expected = [conj.name for conj in ConjectureManager.conjectures_to_check]
+            if kind != HELLO or (expected and conjectures != expected):
+                logger.error(f"Rejected worker {name}, it checks {conjectures} instead of {expected}")
+                conn.send((STOP, f"the coordinator checks {expected}"))
+                return
+
+            with self.lock:
+                self.num_connections += 1
+                worker = f"{name}#{self.num_connections}"
+                self.assigned[worker] = dict()
+            logger.info(f"{worker} connected")
+
+            last_seen = time.time()
+            while not self.finished.is_set():
+                # wake up regularly to notice a silent worker or the end of the campaign
+                if not conn.poll(1.0):
+                    if time.time() - last_seen > self.heartbeat_timeout:
+                        reason = "heartbeat timeout"
+                        return
+                    continue
+
+                message = conn.recv()
+                last_seen = time.time()
+                if message[0] == RESULT:
+                    with self.lock:
+                        self._add_result(worker, message[1])
+                elif message[0] == REQUEST:
+                    with self.lock:
+                        chunk = self._next_chunk(worker)
+                    conn.send((TASKS, chunk))
+
+            conn.send((STOP, "the campaign is finished"))
+        except (EOFError, OSError) as e:
+            reason = repr(e)
+        finally:
+            with self.lock:
+                if worker in self.assigned and not self.finished.is_set():
+                    self._drop(worker, reason)
+            conn.close()
+
+    def _accept(self, listener):
+        while not self.finished.is_set():
+            try:
+                conn = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def run(self) -> SuiteStatistics:
+        logger = get_logger()
+        if self.num_instances <= self.statistics.num_instances:
+            self.finished.set()
+
+        # no authkey here, Listener.accept would run the handshake on the accepting thread
+        with Listener(self.address) as listener:
+            self.address = listener.address
+            self.listening.set()
+            logger.info(f"Coordinator listening on {self.address}")
+            threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+            self.finished.wait()
+            # the connections notice the end within a second and stop their workers
+            time.sleep(1.5)
+
+        if self.checkpoint is not None:
+            self.checkpoint.save(self.generator, self.statistics, self.pending())
+        logger.info(str(self.statistics))
+        logger.info(f"Skipped {self.generator.num_duplicates} duplicate instances")
+        return self.statistics
+
+
+def run_coordinator(generator: InstanceGenerator, num_instances: int, authkey: bytes,
+                    address=("localhost", DEFAULT_PORT), chunk_size=4, log_to_stdout=False, **kwargs):
+    """
+        Verifies num_instances instances on the worker agents that connect to address, see Coordinator.
+
+        Returns:
+                The SuiteStatistics of the run
+    """
+    setup_logger(log_to_stdout)
+    statistics = Coordinator(generator, num_instances, authkey, address, chunk_size, **kwargs).run()
+    print(statistics)
+    return statistics
+
+
+def _shutdown(conn):
+    """ Wakes up a thread that is blocked reading from conn, closing the connection does not """
+    try:
+        with socket.socket(fileno=os.dup(conn.fileno())) as sock:
+            sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def _connect(address, authkey: bytes, timeout: float):
+    """ Retries until the coordinator accepts, it may still be starting up """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def run_worker(address, authkey: bytes, heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+               connect_timeout=DEFAULT_CONNECT_TIMEOUT, log_to_stdout=False):
+    """
+        Connects to a Coordinator and verifies the instances it hands out until it stops the worker or the
+        connection breaks. The conjectures and settings of the ConjectureManager are not sent, they have to be set
+        up in this process the same way as for the coordinator.
+
+        Returns:
+                The number of verified instances
+    """
+    setup_logger(log_to_stdout)
+    logger = get_logger()
+    name = f"{socket.gethostname()}/{multiprocessing.current_process().name}"
+
+    conn = _connect(address, authkey, connect_timeout)
+    send_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def send_heartbeats():
+        while not stopped.wait(heartbeat_interval):
+            try:
+                send((HEARTBEAT,))
+            except OSError:
+                return
+
+    num_verified = 0
+    # counterexamples are written by a background writer, as in _run_pool
+    with OutputWriter(ConjectureManager.render_graphs):
+        try:
+            send((HELLO, name, [conj.name for conj in ConjectureManager.conjectures_to_check]))
+            threading.Thread(target=send_heartbeats, daemon=True).start()
+            while True:
+                send((REQUEST,))
+                kind, payload = conn.recv()
+                if kind == STOP:
+                    logger.info(f"Stopped by the coordinator: {payload}")
+                    break
+                if not payload:
+                    time.sleep(IDLE_WAIT)
+                    continue
+
+                for index, inst in payload:
+                    result = _verify_task(index, inst, name)
+                    get_metrics().maybe_export()
+                    send((RESULT, result))
+                    num_verified += 1
+        except (EOFError, OSError) as e:
+            logger.warning(f"Lost the connection to the coordinator: {e!r}")
+        finally:
+            stopped.set()
+            get_metrics().export()
+            conn.close()
+
+    return num_verified
+
+
+def start_local_workers(address, authkey: bytes, num_workers: int, **kwargs):
+    """
+        Starts worker agents on this machine, they inherit the conjectures and settings of this process.
+
+        Returns:
+                The started processes
+    """
+    ctx = multiprocessing.get_context("fork")
+    workers = [
+        ctx.Process(target=run_worker, args=(address, authkey), kwargs=kwargs, name=f"Agent-{i + 1}")
+        for i in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the conjectures on a coordinator and remote workers.")
+    parser.add_argument("role", choices=["coordinator", "worker"])
+    parser.add_argument("--host", default="localhost", help="the address of the coordinator (workers)")
+    parser.add_argument("--bind", default="", help="the address the coordinator listens on, all interfaces if empty")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--authkey", default=os.environ.get("ECMP_AUTHKEY"),
+                        help="shared secret of coordinator and workers, defaults to $ECMP_AUTHKEY")
+    parser.add_argument("--instances", type=int, default=10000, help="instances to verify (coordinator)")
+    parser.add_argument("--max-nodes", type=int, default=12, help="largest random instance (coordinator)")
+    parser.add_argument("--seed", type=int, help="root seed of the instances (coordinator)")
+    parser.add_argument("--local-workers", type=int, default=0, help="worker agents to start on this machine")
+    args = parser.parse_args()
+    if not args.authkey:
+        parser.error("an authkey is required, pass --authkey or set ECMP_AUTHKEY")
+
+    # the same conjectures as in main.py, coordinator and workers have to agree on them
+    ConjectureManager.setup(CHECK_ON_ALL_SUB_DAGS, ECMP_FORWARDING)
+    ConjectureManager.register(MAIN_CONJECTURE, LOADS_CONJECTURE, LOADS_CONJECTURE.implies(MAIN_CONJECTURE),
+                               MAIN_CONJECTURE.implies(LOADS_CONJECTURE))
+
+    key = args.authkey.encode()
+    if args.role == "worker":
+        run_worker((args.host, args.port), key)
+    else:
+        local_workers = start_local_workers((args.host, args.port), key, args.local_workers)
+        run_coordinator(InstanceGenerator(args.max_nodes, True, args.seed), args.instances, key,
+                        (args.bind, args.port))
+        for agent in local_workers:
+            agent.join()
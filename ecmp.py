@@ -1,10 +1,13 @@
 import itertools
+import math
 from typing import NewType
 
 import more_itertools
-import copy
+import numpy as np
 
 from conjectures import Conjecture, MAIN_CONJECTURE, LOADS_CONJECTURE
+from ecmp_batch import BatchEvaluator
+from ecmp_incremental import IncrementalEvaluator
 from model import *
 
 
@@ -16,7 +19,23 @@ def get_ecmp_DAG(dag: DAG, inst: Instance) -> ECMP_Sol:
     edges = defaultdict(lambda: defaultdict(int))
 
     congestion = 0
-    for node in topologicalSort(dag):
+    if isinstance(dag, CSRDAG):
+        offsets, targets = dag.offsets, dag.targets
+        for node in dag.order:
+            start, end = offsets[node], offsets[node + 1]
+            if end > start:
+                value = node_val[node] / (end - start)
+                for e in range(start, end):
+                    node_val[targets[e]] += value
+                    edges[node][targets[e]] += value
+                congestion = max(congestion, value)
+        return ECMP_Sol(DAG(dag.num_nodes, edges, tuple(dag.order)), congestion, node_val)
+
+    # the ECMP flow is a sub-DAG of dag, so it keeps the same order
+    order = topologicalSort(dag)
+    if not isinstance(order, tuple):
+        order = tuple(order)
+    for node in order:
         degree = len(dag.neighbors[node])
         if degree > 0:
             value = node_val[node] / degree
@@ -25,90 +44,444 @@ def get_ecmp_DAG(dag: DAG, inst: Instance) -> ECMP_Sol:
                 congestion = max(congestion, value)
                 edges[node][nb] += value
 
-    return ECMP_Sol(DAG(dag.num_nodes, edges), congestion, node_val)
+    return ECMP_Sol(DAG(dag.num_nodes, edges, order), congestion, node_val)
 
 
 def _get_removable_edges(dag: DAG):
-    edges = list()
+    nodes, masks = list(), list()
     for node in range(dag.num_nodes):
-        if len(dag.neighbors[node]) > 1:
-            pwset = list(more_itertools.powerset((node, nb) for nb in dag.neighbors[node]))
-            pwset.pop()  # remove empty edgeset
-            edges.append(pwset)
-    return edges
+        degree = len(dag.neighbors[node])
+        if degree > 1:
+            full_mask = (1 << degree) - 1
+            pwset = list(more_itertools.powerset(range(degree)))
+            pwset.pop()  # never remove all edges
+            nodes.append(node)
+            masks.append([full_mask & ~sum(1 << i for i in removed) for removed in pwset])
+    return nodes, masks
 
 
 def _get_single_forwarding_removable_edges(dag: DAG):
-    edges = list()
+    nodes, masks = list(), list()
     for node in range(dag.num_nodes):
-        if len(dag.neighbors[node]) > 1:
-            row = list()
-            lst = [(node, nb) for nb in dag.neighbors[node]]
-            for entry in lst:
-                row.append([x for x in lst if x != entry])
-            edges.append(row)
-    return edges
+        degree = len(dag.neighbors[node])
+        if degree > 1:
+            nodes.append(node)
+            masks.append([1 << i for i in range(degree)])
+    return nodes, masks
 
 
-def iterate_sub_DAG(dag: DAG, mode="ecmp"):
+def _get_edge_masks(dag: DAG, mode: str):
+    """
+        Returns:
+                The branching nodes and for each of them the bitmasks of active out-edges a sub-DAG can choose
+    """
+    if mode == "ecmp":
+        return _get_removable_edges(dag)
+    elif mode == "single_forwarding":
+        return _get_single_forwarding_removable_edges(dag)
+
+    print("iterate_sub_DAG got unexpected 'mode' parameter.\nExpected 'ecmp' or 'single_forwarding'")
+    return None, None
+
+
+def count_sub_DAGs(dag: DAG, mode="ecmp") -> int:
+    """
+        Returns:
+                The number of sub-DAGs iterate_sub_DAG yields for this mode
+    """
+    nodes, masks = _get_edge_masks(dag, mode)
+    if nodes is None:
+        return 0
+    return math.prod(len(m) for m in masks)
+
+
+def _iterate_effective_choices(dag: DAG, inst: Instance, nodes: list, masks: list):
+    """
+        A sub-DAG only matters on the nodes its flow reaches, so all choices that differ only at nodes no source
+        reaches have the same equal-splitting flow. Only one of them is yielded, the one that picks option 0 at
+        every unreached branching node. The nodes are fixed in topological order, so unreached nodes are never
+        branched on.
+
+        Returns:
+                Generator of the choices (one index into each entry of masks) of the effective sub-DAGs, in the
+                order of a depth-first search along the topological order
+    """
+    factor_index = {node: i for i, node in enumerate(nodes)}
+    kept_neighbors = [
+        [[nb for j, nb in enumerate(dag.neighbors[node]) if mask >> j & 1] for mask in masks[i]]
+        for i, node in enumerate(nodes)
+    ]
+    order = list(topologicalSort(dag))
+
+    reached = [False] * inst.dag.num_nodes
+    for s in inst.sources:
+        reached[s] = True
+    choice = [0] * len(nodes)
+
+    def assign(pos: int):
+        # the non-branching nodes up to the next reached branching node only pass the flow on
+        newly_reached = []
+        while pos < len(order) and not (reached[order[pos]] and order[pos] in factor_index):
+            if reached[order[pos]]:
+                for nb in dag.neighbors[order[pos]]:
+                    if not reached[nb]:
+                        reached[nb] = True
+                        newly_reached.append(nb)
+            pos += 1
+
+        if pos == len(order):
+            yield tuple(choice)
+        else:
+            i = factor_index[order[pos]]
+            for option, neighbors in enumerate(kept_neighbors[i]):
+                choice[i] = option
+                added = [nb for nb in neighbors if not reached[nb]]
+                for nb in added:
+                    reached[nb] = True
+                yield from assign(pos + 1)
+                for nb in added:
+                    reached[nb] = False
+            choice[i] = 0
+
+        for nb in newly_reached:
+            reached[nb] = False
+
+    yield from assign(0)
+
+
+def _effective_choices(nodes: list, choices, loads):
+    """
+        Returns:
+                For a batch of choices and their node loads, whether each choice is the one
+                _iterate_effective_choices yields for its effective sub-DAG
+    """
+    return ~((loads[:, nodes] == 0) & (choices != 0)).any(axis=1)
+
+
+def count_effective_sub_DAGs(dag: DAG, inst: Instance, mode="ecmp") -> int:
+    """
+        Counts the sub-DAGs with different equal-splitting flows for inst, see _iterate_effective_choices.
+        The count only depends on the position in the topological order and the reached nodes that are not fixed
+        yet, which are memoized.
+
+        Returns:
+                The number of sub-DAGs iterate_sub_DAG yields for this mode and inst
+    """
+    nodes, masks = _get_edge_masks(dag, mode)
+    if nodes is None:
+        return 0
+
+    factor_index = {node: i for i, node in enumerate(nodes)}
+    neighbor_masks = [sum(1 << nb for nb in dag.neighbors[node]) for node in range(dag.num_nodes)]
+    kept_masks = [
+        [sum(1 << nb for j, nb in enumerate(dag.neighbors[node]) if mask >> j & 1) for mask in masks[i]]
+        for i, node in enumerate(nodes)
+    ]
+    order = list(topologicalSort(dag))
+    remaining = [0] * (len(order) + 1)
+    for pos in reversed(range(len(order))):
+        remaining[pos] = remaining[pos + 1] | 1 << order[pos]
+
+    memo = dict()
+
+    def count(pos: int, reached: int):
+        while pos < len(order) and not (reached >> order[pos] & 1 and order[pos] in factor_index):
+            if reached >> order[pos] & 1:
+                reached |= neighbor_masks[order[pos]]
+            pos += 1
+        if pos == len(order):
+            return 1
+
+        reached &= remaining[pos]
+        if (pos, reached) not in memo:
+            i = factor_index[order[pos]]
+            memo[(pos, reached)] = sum(count(pos + 1, reached | kept) for kept in kept_masks[i])
+        return memo[(pos, reached)]
+
+    return count(0, sum(1 << s for s in inst.sources))
+
+
+def iterate_sub_DAG(dag: DAG, mode="ecmp", as_view=False, inst: Instance = None):
     """
         Parameters:
                 dag (DAG): The DAG to iterate
                 mode ("ecmp" | "single_forwarding"): the type of returned sub-DAG
+                as_view (bool): yield copy-free SubDAG views instead of DAG copies
+                inst (Instance | None): only yield one sub-DAG per equal-splitting flow of this instance (see
+                    _iterate_effective_choices), in depth-first order instead of the order of itertools.product
 
         Returns:
                 Generator to iterate all sub DAGs based on mode
     """
-    if mode == "ecmp":
-        edges = _get_removable_edges(dag)
-    elif mode == "single_forwarding":
-        edges = _get_single_forwarding_removable_edges(dag)
+    nodes, masks = _get_edge_masks(dag, mode)
+    if nodes is None:
+        return None
+
+    if not nodes:
+        yield dag
+        return None
+
+    order = tuple(topologicalSort(dag))
+    if inst is None:
+        choices = itertools.product(*masks)
     else:
-        print("iterate_sub_DAG got unexpected 'mode' parameter.\nExpected 'ecmp' or 'single_forwarding'")
+        choices = (
+            tuple(masks[i][option] for i, option in enumerate(choice))
+            for choice in _iterate_effective_choices(dag, inst, nodes, masks)
+        )
+    for pos in choices:
+        view = SubDAG(dag, dict(zip(nodes, pos)), order)
+        yield view if as_view else view.to_DAG()
+
+
+# slack for congestion values that are summed up in a different order than in get_ecmp_DAG
+BOUND_TOLERANCE = 1e-9
+
+
+def _branch_and_bound(dag: DAG, inst: Instance, nodes: list, masks: list, bound: float):
+    """
+        Fixes the outgoing edges of the nodes in topological order. The load of a node is final once all of its
+        predecessors are fixed, so the congestion of a partial assignment can only grow and the assignment is
+        pruned as soon as it exceeds the best complete congestion found so far. Nodes without load are not
+        branched on, they keep option 0 (see _iterate_effective_choices).
+
+        Parameters:
+                dag (DAG): The DAG to search
+                inst (Instance): The routing instance
+                nodes (list): The branching nodes, as returned by _get_edge_masks
+                masks (list): The choices of active out-edges per branching node, as returned by _get_edge_masks
+                bound (float): Only assignments with congestion up to this value are of interest
+
+        Returns:
+                All choices (one index into each entry of masks) within BOUND_TOLERANCE of the optimal congestion
+    """
+    factor_index = {node: i for i, node in enumerate(nodes)}
+    kept_neighbors = [
+        [[nb for j, nb in enumerate(dag.neighbors[node]) if mask >> j & 1] for mask in masks[i]]
+        for i, node in enumerate(nodes)
+    ]
+    order = list(topologicalSort(dag))
+
+    node_val = [0] * inst.dag.num_nodes
+    for s, d in zip(inst.sources, inst.demands):
+        node_val[s] = d
+
+    choice = [0] * len(nodes)
+    candidates = []
+    best = bound
+
+    # an explicit stack instead of recursion, large instances have more nodes than the recursion limit allows
+    branch_positions = [pos for pos, node in enumerate(order) if node in factor_index]
+    segment_ends = branch_positions + [len(order)]
+
+    def propagate(start: int, end: int, congestion: float, undo: list):
+        """ Forwards the loads of order[start:end], returns None as soon as the congestion exceeds best """
+        for node in order[start:end]:
+            if node_val[node] == 0:
+                continue
+            if node in factor_index:
+                i = factor_index[node]
+                neighbors = kept_neighbors[i][choice[i]]
+            else:
+                neighbors = dag.neighbors[node]
+            if not neighbors:
+                continue
+
+            value = node_val[node] / len(neighbors)
+            congestion = max(congestion, value)
+            if congestion > best + BOUND_TOLERANCE:
+                return None
+            for nb in neighbors:
+                undo.append((nb, node_val[nb]))
+                node_val[nb] += value
+        return congestion
+
+    def restore(undo: list):
+        for nb, val in reversed(undo):
+            node_val[nb] = val
+
+    # [segment, next option of the branching node that ends the segment, undo log of the segment, congestion]
+    stack = []
+
+    def descend(segment: int, start: int, congestion: float):
+        nonlocal best
+        undo = []
+        congestion = propagate(start, segment_ends[segment], congestion, undo)
+        if congestion is None:
+            restore(undo)
+        elif segment == len(branch_positions):
+            best = min(best, congestion)
+            candidates.append((tuple(choice), congestion))
+            restore(undo)
+        else:
+            stack.append([segment, 0, undo, congestion])
+
+    descend(0, 0, 0)
+    while stack:
+        frame = stack[-1]
+        segment, option, undo, congestion = frame
+        node = order[segment_ends[segment]]
+        i = factor_index[node]
+        num_options = len(kept_neighbors[i]) if node_val[node] != 0 else 1
+        if option == num_options:
+            choice[i] = 0
+            restore(undo)
+            stack.pop()
+            continue
+
+        frame[1] += 1
+        choice[i] = option
+        # the next segment starts with the branching node and its chosen out-edges
+        descend(segment + 1, segment_ends[segment], congestion)
+
+    # sorting the choices restores the order of itertools.product
+    return sorted(pos for pos, congestion in candidates if congestion <= best + BOUND_TOLERANCE)
+
+
+def _batch_search(dag: DAG, inst: Instance, nodes: list, masks: list, bound: float):
+    """
+        Evaluates every sub-DAG with the vectorized BatchEvaluator.
+
+        Returns:
+                All effective choices (see _iterate_effective_choices) within BOUND_TOLERANCE of the optimal
+                congestion in the order of itertools.product
+    """
+    evaluator = BatchEvaluator(dag, inst, nodes, masks)
+    candidates = []
+    best = bound
+    for choices, congestion, loads in evaluator.iterate_batches():
+        best = min(best, congestion.min())
+        selected = (congestion <= best + BOUND_TOLERANCE) & _effective_choices(nodes, choices, loads)
+        candidates.extend(zip(map(tuple, choices[selected].tolist()), congestion[selected]))
+
+    return [pos for pos, congestion in candidates if congestion <= best + BOUND_TOLERANCE]
+
+
+def _gray_code_search(dag: DAG, inst: Instance, nodes: list, masks: list, bound: float):
+    """
+        Evaluates every sub-DAG incrementally in Gray code order with the IncrementalEvaluator.
+
+        Returns:
+                All effective choices (see _iterate_effective_choices) within BOUND_TOLERANCE of the optimal
+                congestion in the order of itertools.product
+    """
+    candidates = []
+    best = bound
+    for evaluator in IncrementalEvaluator(dag, inst, nodes, masks).iterate():
+        congestion = evaluator.congestion
+        if congestion <= best + BOUND_TOLERANCE and evaluator.is_effective():
+            best = min(best, congestion)
+            candidates.append((tuple(evaluator.choice), congestion))
+
+    return sorted(pos for pos, congestion in candidates if congestion <= best + BOUND_TOLERANCE)
+
+
+BRANCH_AND_BOUND = "branch_and_bound"
+BATCH_ENUMERATION = "batch"
+GRAY_CODE_ENUMERATION = "gray_code"
+
+
+def _iterate_optimal_sub_DAG_candidates(dag: DAG, inst: Instance, mode="ecmp", bound=float('inf'),
+                                        search=BRANCH_AND_BOUND):
+    """
+        Yields a superset of the optimal effective sub-DAGs (see _iterate_effective_choices) as SubDAG views in the
+        order of itertools.product. Every sub-DAG that is skipped has a strictly larger congestion than the
+        optimum (or than bound) or the same flow as one that is yielded.
+    """
+    nodes, masks = _get_edge_masks(dag, mode)
+    if nodes is None:
         return None
 
-    if not edges:
+    if not nodes:
         yield dag
         return None
 
-    for pos in itertools.product(*edges):
-        cp = copy.deepcopy(dag)
-        for i in pos:
-            for node, nb in i:
-                del cp.neighbors[node][nb]
-        yield cp
+    if search == BRANCH_AND_BOUND:
+        choices = _branch_and_bound(dag, inst, nodes, masks, bound)
+    elif search == BATCH_ENUMERATION:
+        choices = _batch_search(dag, inst, nodes, masks, bound)
+    elif search == GRAY_CODE_ENUMERATION:
+        choices = _gray_code_search(dag, inst, nodes, masks, bound)
+    else:
+        raise RuntimeError(f"Invalid value for search: {search}")
+
+    order = tuple(topologicalSort(dag))
+    for choice in choices:
+        yield SubDAG(dag, {node: masks[i][option] for i, (node, option) in enumerate(zip(nodes, choice))}, order)
+
+
+def iterate_ecmp_solutions(dag: DAG, inst: Instance, mode="ecmp", batch_size=None, gray_code=False,
+                           skip_duplicates=True):
+    """
+        Parameters:
+                dag (DAG): The DAG to iterate
+                inst (Instance): The routing instance
+                mode ("ecmp" | "single_forwarding"): the type of sub-DAGs
+                batch_size (int | None): evaluate blocks of this many sub-DAGs at once with NumPy, or one at a time
+                gray_code (bool): visit the sub-DAGs in Gray code order and only re-evaluate the region below the
+                    node that changed. Takes precedence over batch_size.
+                skip_duplicates (bool): only yield one ECMP_Sol per effective sub-DAG (see
+                    _iterate_effective_choices). One at a time, the unreached nodes are not even branched on.
+
+        Returns:
+                Generator of the ECMP_Sol of every sub-DAG, in the order of iterate_sub_DAG unless gray_code is set
+    """
+    if batch_size is None and not gray_code:
+        for sub_dag in iterate_sub_DAG(dag, mode, as_view=True, inst=inst if skip_duplicates else None):
+            yield get_ecmp_DAG(sub_dag, inst)
+        return None
+
+    nodes, masks = _get_edge_masks(dag, mode)
+    if nodes is None:
+        return None
+
+    if not nodes:
+        yield get_ecmp_DAG(dag, inst)
+        return None
+
+    if gray_code:
+        for evaluator in IncrementalEvaluator(dag, inst, nodes, masks).iterate():
+            if not skip_duplicates or evaluator.is_effective():
+                yield evaluator.ecmp_solution()
+        return None
+
+    evaluator = BatchEvaluator(dag, inst, nodes, masks)
+    for choices, congestion, loads in evaluator.iterate_batches(batch_size):
+        effective = _effective_choices(nodes, choices, loads) if skip_duplicates else np.ones(len(choices), bool)
+        for i in np.flatnonzero(effective):
+            yield evaluator.ecmp_solution(choices[i], congestion[i], loads[i])
 
 
-def get_optimal_ECMP_sub_DAG(dag: DAG, inst: Instance) -> ECMP_Sol:
+def get_optimal_ECMP_sub_DAG(dag: DAG, inst: Instance, search=BRANCH_AND_BOUND) -> ECMP_Sol:
     best = ECMP_Sol(None, dag.num_nodes, [])
-    for sub_dag in iterate_sub_DAG(dag):
+    for sub_dag in _iterate_optimal_sub_DAG_candidates(dag, inst, bound=best.congestion, search=search):
         result = get_ecmp_DAG(sub_dag, inst)
         if result.congestion < best.congestion:
             best = result
     return best
 
 
-def get_ALL_optimal_ECMP_sub_DAGs(dag: DAG, inst: Instance) -> list[ECMP_Sol]:
+def get_ALL_optimal_ECMP_sub_DAGs(dag: DAG, inst: Instance, search=BRANCH_AND_BOUND) -> list[ECMP_Sol]:
     all_best = []
     best_congestion = float('inf')
-    for sub_dag in iterate_sub_DAG(dag):
+    for sub_dag in _iterate_optimal_sub_DAG_candidates(dag, inst, search=search):
         result = get_ecmp_DAG(sub_dag, inst)
         if result.congestion < best_congestion:
             all_best = [result]
             best_congestion = result.congestion
-        if result.congestion == best_congestion:
+        elif result.congestion == best_congestion:
             all_best.append(result)
     return all_best
 
 
-def get_ALL_optimal_single_forwarding_DAGs(dag: DAG, inst: Instance) -> list[ECMP_Sol]:
+def get_ALL_optimal_single_forwarding_DAGs(dag: DAG, inst: Instance, search=BRANCH_AND_BOUND) -> list[ECMP_Sol]:
     all_best = []
     best_congestion = float('inf')
-    for sub_dag in iterate_sub_DAG(dag, mode="single_forwarding"):
+    for sub_dag in _iterate_optimal_sub_DAG_candidates(dag, inst, mode="single_forwarding", search=search):
         result = get_ecmp_DAG(sub_dag, inst)
         if result.congestion < best_congestion:
             all_best = [result]
             best_congestion = result.congestion
-        if result.congestion == best_congestion:
+        elif result.congestion == best_congestion:
             all_best.append(result)
     return all_best
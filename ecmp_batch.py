@@ -0,0 +1,136 @@
+import math
+
+import numpy as np
+
+from model import *
+
+DEFAULT_BATCH_SIZE = 4096
+
+
+class _ECMPNeighbors:
+    __slots__ = ("dag", "node_masks", "loads", "cache")
+
+    def __init__(self, dag: DAG, node_masks: dict, loads):
+        self.dag = dag
+        self.node_masks = node_masks
+        self.loads = loads
+        self.cache = dict()
+
+    def __getitem__(self, node):
+        if node not in self.cache:
+            neighbors = list(self.dag.neighbors[node])
+            if node in self.node_masks:
+                mask = self.node_masks[node]
+                neighbors = [nb for i, nb in enumerate(neighbors) if mask >> i & 1]
+            value = self.loads[node] / len(neighbors) if neighbors else 0
+            self.cache[node] = {nb: value for nb in neighbors}
+        return self.cache[node]
+
+
+class ECMPFlow:
+    """
+        The equal-splitting flow of one candidate of a batch, built lazily from its node loads.
+        It has the same num_nodes and neighbors interface as the DAG in an ECMP_Sol returned by get_ecmp_DAG.
+    """
+    __slots__ = ("num_nodes", "neighbors", "order")
+
+    def __init__(self, dag: DAG, node_masks: dict, loads, order=None):
+        self.num_nodes = dag.num_nodes
+        self.neighbors = _ECMPNeighbors(dag, node_masks, loads)
+        self.order = order
+
+
+class BatchEvaluator:
+    """
+        Evaluates equal-splitting on many sub-DAGs of one DAG at once. A candidate is a row of option indices,
+        one per branching node, into the out-edge bitmasks of that node (see ecmp._get_edge_masks).
+        The node values of all candidates of a batch are propagated together along a fixed topological order
+        of the DAG, so the Python loop only runs over the edges and not over the candidates.
+    """
+
+    def __init__(self, dag: DAG, inst: Instance, nodes: list, masks: list):
+        self.dag = dag
+        self.nodes = nodes
+        self.masks = masks
+        csr = as_csr(dag)
+        self.order = tuple(csr.order)
+        self.out_neighbors = [
+            csr.targets[csr.offsets[node]:csr.offsets[node + 1]].tolist() for node in range(dag.num_nodes)
+        ]
+        self.factor_index = {node: i for i, node in enumerate(nodes)}
+
+        # per branching node: which out-edges each option keeps and how many
+        self.active_edges = [
+            np.array([[mask >> j & 1 for j in range(len(self.out_neighbors[node]))] for mask in masks[i]],
+                     dtype=np.float64)
+            for i, node in enumerate(nodes)
+        ]
+        self.degrees = [active.sum(axis=1) for active in self.active_edges]
+
+        self.radices = [len(m) for m in masks]
+        self.num_candidates = math.prod(self.radices)
+
+        self.initial_loads = np.zeros(inst.dag.num_nodes)
+        for s, d in zip(inst.sources, inst.demands):
+            self.initial_loads[s] = d
+
+    def choices(self, start: int, stop: int):
+        """
+            Returns:
+                    The candidates with indices start, ..., stop - 1 in the order of itertools.product
+        """
+        index = np.arange(start, stop, dtype=np.int64)
+        choices = np.empty((len(index), len(self.radices)), dtype=np.int64)
+        for f in reversed(range(len(self.radices))):
+            index, choices[:, f] = np.divmod(index, self.radices[f])
+        return choices
+
+    def evaluate(self, choices):
+        """
+            Returns:
+                    The congestion of every candidate (shape B) and the node loads (shape B x num_nodes)
+        """
+        batch = len(choices)
+        loads = np.repeat(self.initial_loads[:, np.newaxis], batch, axis=1)
+        congestion = np.zeros(batch)
+
+        for node in self.order:
+            neighbors = self.out_neighbors[node]
+            if not neighbors:
+                continue
+
+            if node in self.factor_index:
+                f = self.factor_index[node]
+                option = choices[:, f]
+                active = self.active_edges[f][option]
+                value = loads[node] / self.degrees[f][option]
+                for j, nb in enumerate(neighbors):
+                    loads[nb] += value * active[:, j]
+            else:
+                value = loads[node] / len(neighbors)
+                for nb in neighbors:
+                    loads[nb] += value
+
+            np.maximum(congestion, value, out=congestion)
+
+        return congestion, loads.T
+
+    def iterate_batches(self, batch_size=DEFAULT_BATCH_SIZE):
+        """
+            Returns:
+                    Generator of (choices, congestion, loads) for consecutive blocks of all candidates
+        """
+        for start in range(0, self.num_candidates, batch_size):
+            choices = self.choices(start, min(start + batch_size, self.num_candidates))
+            congestion, loads = self.evaluate(choices)
+            yield choices, congestion, loads
+
+    def node_masks(self, choice) -> dict:
+        return {node: self.masks[i][option] for i, (node, option) in enumerate(zip(self.nodes, choice))}
+
+    def sub_DAG(self, choice) -> SubDAG:
+        return SubDAG(self.dag, self.node_masks(choice), self.order)
+
+    def ecmp_solution(self, choice, congestion, loads) -> ECMP_Sol:
+        loads = loads.tolist()
+        return ECMP_Sol(ECMPFlow(self.dag, self.node_masks(choice), loads, self.order), float(congestion), loads)
@@ -0,0 +1,166 @@
+import heapq
+
+from ecmp_batch import ECMPFlow
+from model import *
+
+
+def mixed_radix_gray_code(radices: list):
+    """
+        Loopless reflected mixed-radix Gray code (Knuth, TAOCP 7.2.1.1, Algorithm H).
+        Every radix must be at least 2. Digit 0 changes most often.
+
+        Returns:
+                Generator of (digit, value) pairs, one per step after the initial all-zero word.
+                Consecutive words differ in exactly this one digit, by +-1.
+    """
+    n = len(radices)
+    word = [0] * n
+    direction = [1] * n
+    focus = list(range(n + 1))
+
+    while True:
+        j = focus[0]
+        focus[0] = 0
+        if j == n:
+            return
+        word[j] += direction[j]
+        yield j, word[j]
+        if word[j] == 0 or word[j] == radices[j] - 1:
+            direction[j] = -direction[j]
+            focus[j] = focus[j + 1]
+            focus[j + 1] = j + 1
+
+
+class IncrementalEvaluator:
+    """
+        Keeps the equal-splitting loads of one sub-DAG and updates them when a single branching node changes its
+        active out-edges. Only nodes downstream of that node whose inflow actually changed are re-evaluated, in
+        topological order, and the congestion is kept in a lazy max-heap.
+        Branching nodes and bitmasks are given as returned by ecmp._get_edge_masks.
+    """
+
+    def __init__(self, dag: DAG, inst: Instance, nodes: list, masks: list):
+        self.dag = dag
+        self.nodes = nodes
+        self.masks = masks
+        csr = as_csr(dag)
+        self.order = tuple(csr.order)
+        self.position = [0] * dag.num_nodes
+        for pos, node in enumerate(self.order):
+            self.position[node] = pos
+
+        self.out_neighbors = [
+            csr.targets[csr.offsets[node]:csr.offsets[node + 1]].tolist() for node in range(dag.num_nodes)
+        ]
+        self.in_edges = [[] for _ in range(dag.num_nodes)]
+        for node in range(dag.num_nodes):
+            for j, nb in enumerate(self.out_neighbors[node]):
+                self.in_edges[nb].append((node, j))
+
+        self.initial_loads = [0] * inst.dag.num_nodes
+        for s, d in zip(inst.sources, inst.demands):
+            self.initial_loads[s] = d
+
+        self.choice = [0] * len(nodes)
+        self.node_mask = [(1 << len(self.out_neighbors[node])) - 1 for node in range(dag.num_nodes)]
+        for node, node_masks in zip(nodes, masks):
+            self.node_mask[node] = node_masks[0]
+
+        self.loads = list(self.initial_loads)
+        self.edge_value = [0] * dag.num_nodes
+        self.version = [0] * dag.num_nodes
+        self.heap = []
+
+        for node in self.order:
+            self._evaluate(node)
+
+    def _active(self, node: int):
+        mask = self.node_mask[node]
+        return [nb for j, nb in enumerate(self.out_neighbors[node]) if mask >> j & 1]
+
+    def _evaluate(self, node: int):
+        """
+            Recomputes load and outgoing edge value of node from its predecessors.
+
+            Returns:
+                    True if the value sent along the outgoing edges changed
+        """
+        load = self.initial_loads[node]
+        for pred, j in self.in_edges[node]:
+            if self.node_mask[pred] >> j & 1:
+                load += self.edge_value[pred]
+        self.loads[node] = load
+
+        degree = bin(self.node_mask[node]).count("1")
+        value = load / degree if degree > 0 else 0
+        if value == self.edge_value[node] and self.version[node] > 0:
+            return False
+
+        self.edge_value[node] = value
+        self.version[node] += 1
+        if degree > 0:
+            heapq.heappush(self.heap, (-value, node, self.version[node]))
+        return True
+
+    def set_option(self, factor: int, option: int):
+        node = self.nodes[factor]
+        old_mask = self.node_mask[node]
+        self.choice[factor] = option
+        self.node_mask[node] = self.masks[factor][option]
+
+        pending = [self.position[node]]
+        queued = {node}
+        while pending:
+            current = self.order[heapq.heappop(pending)]
+            queued.discard(current)
+            value_changed = self._evaluate(current)
+
+            if current == node:
+                # the edges that were switched on or off always see a different inflow
+                changed = old_mask ^ self.node_mask[node]
+                if value_changed:
+                    changed |= old_mask | self.node_mask[node]
+            elif value_changed:
+                changed = self.node_mask[current]
+            else:
+                continue
+
+            for j, nb in enumerate(self.out_neighbors[current]):
+                if changed >> j & 1 and nb not in queued:
+                    queued.add(nb)
+                    heapq.heappush(pending, self.position[nb])
+
+    @property
+    def congestion(self):
+        while self.heap:
+            value, node, version = self.heap[0]
+            if version == self.version[node]:
+                return -value
+            heapq.heappop(self.heap)
+        return 0
+
+    def is_effective(self):
+        """ Whether every branching node without load has option 0, see ecmp._iterate_effective_choices """
+        return all(self.loads[node] != 0 or option == 0 for node, option in zip(self.nodes, self.choice))
+
+    def node_masks(self) -> dict:
+        return {node: self.node_mask[node] for node in self.nodes}
+
+    def ecmp_solution(self) -> ECMP_Sol:
+        loads = list(self.loads)
+        return ECMP_Sol(ECMPFlow(self.dag, self.node_masks(), loads, self.order), self.congestion, loads)
+
+    def iterate(self):
+        """
+            Walks through all sub-DAGs in Gray code order, so consecutive sub-DAGs differ at a single node.
+            The digit that changes most often belongs to the branching node that comes last in topological order,
+            which keeps the re-evaluated region small.
+
+            Returns:
+                    Generator that yields this evaluator once per sub-DAG, in its updated state
+        """
+        factors = sorted(range(len(self.nodes)), key=lambda f: -self.position[self.nodes[f]])
+        yield self
+        for digit, option in mixed_radix_gray_code([len(self.masks[f]) for f in factors]):
+            self.set_option(factors[digit], option)
+            yield self
@@ -0,0 +1,178 @@
+import os
+from collections import namedtuple, defaultdict
+
+try:
+    import gurobipy as gp
+    from gurobipy import GRB
+except ImportError:
+    gp = None
+
+try:
+    import scipy.sparse
+    from scipy.optimize import linprog
+except ImportError:
+    linprog = None
+
+GUROBI_BACKEND = "gurobi"
+HIGHS_BACKEND = "highs"
+DEFAULT_BACKEND = HIGHS_BACKEND if linprog is not None else GUROBI_BACKEND
+
+LPResult = namedtuple("LPResult", "objective, values")
+
+
+class LinearProgram:
+    """
+        A minimization LP over non-negative variables with sparse '<=' and '==' constraints.
+        Formulations build it once, every backend solves it in its own way.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.objective = []
+        # sparse rows in coordinate format
+        self.ub_rows, self.ub_cols, self.ub_vals, self.ub_rhs = [], [], [], []
+        self.eq_rows, self.eq_cols, self.eq_vals, self.eq_rhs = [], [], [], []
+
+    @property
+    def num_vars(self):
+        return len(self.objective)
+
+    def add_variable(self, name: str, obj=0.0):
+        self.names.append(name)
+        self.objective.append(obj)
+        return len(self.objective) - 1
+
+    def add_constraint(self, coefficients: dict, sense: str, rhs: float):
+        if sense == "<=":
+            rows, cols, vals, rhs_list = self.ub_rows, self.ub_cols, self.ub_vals, self.ub_rhs
+        elif sense == ">=":
+            coefficients = {var: -coef for var, coef in coefficients.items()}
+            rows, cols, vals, rhs_list = self.ub_rows, self.ub_cols, self.ub_vals, self.ub_rhs
+            rhs = -rhs
+        elif sense == "==":
+            rows, cols, vals, rhs_list = self.eq_rows, self.eq_cols, self.eq_vals, self.eq_rhs
+        else:
+            raise RuntimeError(f"Invalid constraint sense: {sense}")
+
+        row = len(rhs_list)
+        for var, coef in coefficients.items():
+            rows.append(row)
+            cols.append(var)
+            vals.append(coef)
+        rhs_list.append(rhs)
+
+
+class LPBackend:
+    name = None
+
+    def solve(self, lp: LinearProgram):
+        """
+            Returns:
+                    An LPResult with the optimal objective and variable values or None if the LP is infeasible
+        """
+        raise NotImplementedError
+
+
+class GurobiBackend(LPBackend):
+    name = GUROBI_BACKEND
+
+    def __init__(self):
+        if gp is None:
+            raise RuntimeError("The gurobi backend requires the gurobipy package.")
+
+        # one environment per process, so we only pay the license check and setup once
+        self.env = gp.Env(empty=True)
+        self.env.setParam("OutputFlag", 0)
+        self.env.start()
+
+    @staticmethod
+    def _add_constraints(m, variables, rows, cols, vals, rhs, sense):
+        row_entries = defaultdict(list)
+        for row, col, val in zip(rows, cols, vals):
+            row_entries[row].append((val, variables[col]))
+
+        for row, value in enumerate(rhs):
+            coefficients = [val for val, _ in row_entries[row]]
+            expr_vars = [var for _, var in row_entries[row]]
+            m.addLConstr(gp.LinExpr(coefficients, expr_vars), sense, value)
+
+    def solve(self, lp: LinearProgram):
+        try:
+            with gp.Model("ecmp_opt", env=self.env) as m:
+                variables = [
+                    m.addVar(name=name, obj=obj, lb=0, ub=GRB.INFINITY, vtype=GRB.CONTINUOUS)
+                    for name, obj in zip(lp.names, lp.objective)
+                ]
+                m.ModelSense = GRB.MINIMIZE
+
+                self._add_constraints(m, variables, lp.ub_rows, lp.ub_cols, lp.ub_vals, lp.ub_rhs, GRB.LESS_EQUAL)
+                self._add_constraints(m, variables, lp.eq_rows, lp.eq_cols, lp.eq_vals, lp.eq_rhs, GRB.EQUAL)
+
+                m.optimize()
+
+                if m.status in (GRB.INFEASIBLE, GRB.INF_OR_UNBD):
+                    return None
+
+                return LPResult(m.ObjVal, [v.X for v in variables])
+
+        except gp.GurobiError as e:
+            print('Error code ' + str(e.message) + ': ' + str(e))
+
+        return None
+
+
+class HighsBackend(LPBackend):
+    name = HIGHS_BACKEND
+
+    def __init__(self):
+        if linprog is None:
+            raise RuntimeError("The highs backend requires the scipy package.")
+
+    @staticmethod
+    def _matrix(rows, cols, vals, num_rows, num_vars):
+        if num_rows == 0:
+            return None
+        return scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(num_rows, num_vars))
+
+    def solve(self, lp: LinearProgram):
+        res = linprog(
+            lp.objective,
+            A_ub=self._matrix(lp.ub_rows, lp.ub_cols, lp.ub_vals, len(lp.ub_rhs), lp.num_vars),
+            b_ub=lp.ub_rhs or None,
+            A_eq=self._matrix(lp.eq_rows, lp.eq_cols, lp.eq_vals, len(lp.eq_rhs), lp.num_vars),
+            b_eq=lp.eq_rhs or None,
+            bounds=(0, None),
+            method="highs"
+        )
+
+        if res.status == 2:
+            # infeasible
+            return None
+
+        if res.status != 0:
+            print(f"HiGHS failed with status {res.status}: {res.message}")
+            return None
+
+        return LPResult(float(res.fun), res.x.tolist())
+
+
+BACKENDS = {
+    GUROBI_BACKEND: GurobiBackend,
+    HIGHS_BACKEND: HighsBackend,
+}
+
+_backend_instances = dict()
+
+
+def get_backend(name: str) -> LPBackend:
+    """
+        Returns the backend with the given name. Instances are created lazily and cached per process,
+        since solver environments must not be shared with forked workers.
+    """
+    if name not in BACKENDS:
+        raise RuntimeError(f"Invalid value for LP backend: {name}. Expected one of {list(BACKENDS)}")
+
+    key = (name, os.getpid())
+    if key not in _backend_instances:
+        _backend_instances[key] = BACKENDS[name]()
+    return _backend_instances[key]
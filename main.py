@@ -1,9 +1,28 @@
-from multiprocessing import Process
+import itertools
+import math
+import multiprocessing
+import os
+import pickle
+import random
+import time
+
+import numpy as np
 
 from model import *
-from optimal_solver import calculate_optimal_solution
-from ecmp import get_ALL_optimal_ECMP_sub_DAGs, iterate_sub_DAG, get_ecmp_DAG
-from conjectures import MAIN_CONJECTURE, LOADS_CONJECTURE, Conjecture
+from canonical import instance_hash
+from batch_generator import build_random_DAGs
+from mutations import mutate_instance
+from topologies import Topology, build_topology_instance, SHORTEST_PATHS
+from solution_store import SolutionStore
+from checkpoint import Checkpointer
+from preprocessing import reduce_instance, calculate_reduced_solution
+from stage_metrics import get_metrics, read_metrics, clear_metrics
+from output_writer import OutputWriter, write_graph, write_pickle, unique_name, set_render_graphs
+from optimal_solver import calculate_optimal_solution, PATH_FORMULATION
+from lp_backends import DEFAULT_BACKEND
+from ecmp import get_ALL_optimal_ECMP_sub_DAGs, get_ALL_optimal_single_forwarding_DAGs, iterate_ecmp_solutions, \
+    count_sub_DAGs, count_effective_sub_DAGs, BRANCH_AND_BOUND
+from conjectures import MAIN_CONJECTURE, LOADS_CONJECTURE, Conjecture, FlowMetrics, MetricsContext
 
 CHECK_ON_OPTIMAL_SUB_DAGS_ONLY = 0
 CHECK_ON_ALL_SUB_DAGS = 1
@@ -13,84 +32,355 @@ INTEGRAL_FORWARDING = "single_forwarding"
 
 
 class InstanceGenerator:
-    def __init__(self, max_nodes: int, arbitrary_demands=True):
-        if max_nodes > 20:
+    """
+        Generates random instances from reproducible seeds. The seed of every instance is derived from the root seed
+        and the instance index, so any instance can be rebuilt with instance(index) independent of which process
+        generated it.
+        With skip_duplicates, instances whose canonical hash was already generated are skipped before anything
+        is solved for them.
+    """
+
+    # larger instances are rejected, None for no limit
+    max_recommended_nodes = 20
+
+    def __init__(self, max_nodes: int, arbitrary_demands=True, seed=None, skip_duplicates=True,
+                 up_to_isomorphism=True, max_incoming_edges=DEFAULT_MAX_INCOMING_EDGES,
+                 max_outgoing_edges=DEFAULT_MAX_OUTGOING_EDGES):
+        if self.max_recommended_nodes is not None and max_nodes > self.max_recommended_nodes:
             raise RuntimeWarning("The value for max_nodes is too large. Expect long runtime!")
 
         self.max_nodes = max_nodes
         self.arbitrary_demands = arbitrary_demands
-
-        random_bytes = os.urandom(8)
-        seed = int.from_bytes(random_bytes, byteorder="big")
-        random.seed(seed)
+        self.max_incoming_edges = max_incoming_edges
+        self.max_outgoing_edges = max_outgoing_edges
+        self.skip_duplicates = skip_duplicates
+        self.up_to_isomorphism = up_to_isomorphism
+
+        if seed is None:
+            random_bytes = os.urandom(8)
+            seed = int.from_bytes(random_bytes, byteorder="big")
+        self.seed = seed
+
+        self.index = 0
+        self.last_index = None
+        self.last_seed = None
+        self.seen_hashes = set()
+        self.num_duplicates = 0
+
+    def instance_seed(self, index: int) -> int:
+        return int(np.random.SeedSequence(self.seed, spawn_key=(index,)).generate_state(1, np.uint64)[0])
+
+    def instance(self, index: int) -> Instance:
+        rng = random.Random(self.instance_seed(index))
+        size = rng.randint(4, self.max_nodes)
+        prob = rng.random() * 0.7 + 0.1
+        logger = get_logger()
+        logger.info(f"Building Instance {index} on {size} nodes with edge probability {prob:0.3f} "
+                    f"(seed {self.seed})")
+        return build_random_DAG(size, prob, self.arbitrary_demands, rng, self.max_incoming_edges,
+                                self.max_outgoing_edges)
 
     def __next__(self):
-        size = random.randint(4, self.max_nodes)
-        prob = random.random() * 0.7 + 0.1
-        logger = get_logger()
-        logger.info(f"Building Instance on {size} nodes with edge probability {prob:0.3f}")
-        inst = build_random_DAG(size, prob, self.arbitrary_demands)
-        return inst
+        while True:
+            index = self.index
+            self.index += 1
+            inst = self.instance(index)
+
+            if self.skip_duplicates:
+                inst_hash = instance_hash(inst, self.up_to_isomorphism)
+                if inst_hash in self.seen_hashes:
+                    self.num_duplicates += 1
+                    get_logger().info(f"-> Skipping duplicate of an earlier instance ({inst_hash[:12]})")
+                    continue
+                self.seen_hashes.add(inst_hash)
+
+            self.last_index = index
+            self.last_seed = self.instance_seed(index)
+            return inst
 
     def __iter__(self):
         return self
 
+    def report(self, index: int, ratio):
+        """ Feedback of the suites: the ECMP to optimal congestion ratio of a verified instance (None if unknown) """
+        pass
+
+
+class SearchInstanceGenerator(InstanceGenerator):
+    """
+        Searches for hard instances instead of sampling blindly: an evolutionary pool keeps the population_size
+        instances with the highest reported congestion ratio, and every new instance is a mutation (see
+        mutations.py) of a tournament winner of the pool. With probability explore, and until the pool is full,
+        a fresh random instance is drawn instead.
+        Only the random instances can be rebuilt from their index, the mutants depend on the order of the feedback.
+        In a multiprocessing suite, the feedback of an instance arrives once its chunk is verified, smaller chunks
+        make the search react faster.
+    """
+
+    def __init__(self, max_nodes: int, arbitrary_demands=True, seed=None, skip_duplicates=True,
+                 up_to_isomorphism=True, max_incoming_edges=DEFAULT_MAX_INCOMING_EDGES,
+                 max_outgoing_edges=DEFAULT_MAX_OUTGOING_EDGES, population_size=32, tournament_size=3,
+                 max_mutations=3, explore=0.1):
+        super().__init__(max_nodes, arbitrary_demands, seed, skip_duplicates, up_to_isomorphism, max_incoming_edges,
+                         max_outgoing_edges)
+        self.population_size = population_size
+        self.tournament_size = tournament_size
+        self.max_mutations = max_mutations
+        self.explore = explore
+        # (ratio, index, instance) of the hardest instances so far, and the instances still waiting for feedback
+        self.population = []
+        self.pending = dict()
+        self.best_ratio = None
+
+    def instance(self, index: int) -> Instance:
+        rng = random.Random(
+            int(np.random.SeedSequence(self.seed, spawn_key=(index, 1)).generate_state(1, np.uint64)[0])
+        )
+        if len(self.population) < self.population_size or rng.random() < self.explore:
+            return super().instance(index)
+
+        ratio, parent_index, parent = max(rng.sample(self.population, min(self.tournament_size,
+                                                                          len(self.population))))
+        get_logger().info(f"Mutating Instance {index} from instance {parent_index} with ratio {ratio:0.4f}")
+        return mutate_instance(parent, rng, rng.randint(1, self.max_mutations), self.arbitrary_demands,
+                               self.max_incoming_edges, self.max_outgoing_edges)
+
+    def __next__(self):
+        inst = super().__next__()
+        self.pending[self.last_index] = inst
+        return inst
+
+    def report(self, index: int, ratio):
+        inst = self.pending.pop(index, None)
+        if inst is None or ratio is None:
+            return
+        if self.best_ratio is None or ratio > self.best_ratio:
+            self.best_ratio = ratio
+            get_logger().info(f"New best congestion ratio {ratio:0.4f} (instance {index})")
+
+        if len(self.population) < self.population_size:
+            self.population.append((ratio, index, inst))
+        elif ratio > min(self.population)[0]:
+            self.population.remove(min(self.population))
+            self.population.append((ratio, index, inst))
+
+
+class TopologyInstanceGenerator(InstanceGenerator):
+    """
+        Samples traffic on a fixed topology (see topologies.py): every instance gets its own target, sources and
+        demands, drawn from the seed of its index. The remaining parameters are passed to build_topology_instance.
+    """
+
+    max_recommended_nodes = None
+
+    def __init__(self, topology: Topology, arbitrary_demands=True, seed=None, skip_duplicates=True,
+                 up_to_isomorphism=True, target=None, num_sources=None, max_demand=None,
+                 orientation=SHORTEST_PATHS):
+        super().__init__(topology.num_nodes, arbitrary_demands, seed, skip_duplicates, up_to_isomorphism)
+        self.topology = topology
+        self.target = target
+        self.num_sources = num_sources
+        self.max_demand = max_demand
+        self.orientation = orientation
+
+    def instance(self, index: int) -> Instance:
+        rng = random.Random(self.instance_seed(index))
+        get_logger().info(f"Building Instance {index} on {self.topology.name} (seed {self.seed})")
+        return build_topology_instance(self.topology, rng, self.target, self.num_sources, self.arbitrary_demands,
+                                       self.max_demand, self.orientation)
+
+
+class BatchInstanceGenerator(InstanceGenerator):
+    """
+        Samples the instances batch_size at a time with the vectorized build_random_DAGs, which stays fast on
+        thousands of nodes. All instances of a batch share the number of nodes (min_nodes to max_nodes) and the
+        edge probability. The seed of an instance is the seed of its batch, instance(index) samples the whole
+        batch again unless it is the last one used.
+    """
+
+    max_recommended_nodes = None
+
+    def __init__(self, max_nodes: int, arbitrary_demands=True, seed=None, skip_duplicates=True,
+                 up_to_isomorphism=True, max_incoming_edges=DEFAULT_MAX_INCOMING_EDGES,
+                 max_outgoing_edges=DEFAULT_MAX_OUTGOING_EDGES, batch_size=64, min_nodes=4):
+        super().__init__(max_nodes, arbitrary_demands, seed, skip_duplicates, up_to_isomorphism, max_incoming_edges,
+                         max_outgoing_edges)
+        self.batch_size = batch_size
+        self.min_nodes = min_nodes
+        self.batch_index = None
+        self.batch = None
+
+    def instance_seed(self, index: int) -> int:
+        return super().instance_seed(index // self.batch_size)
+
+    def instance(self, index: int) -> Instance:
+        batch_index = index // self.batch_size
+        if batch_index != self.batch_index:
+            rng = np.random.default_rng(self.instance_seed(index))
+            size = int(rng.integers(self.min_nodes, self.max_nodes + 1))
+            prob = rng.random() * 0.7 + 0.1
+            get_logger().info(f"Building instances {batch_index * self.batch_size} to "
+                              f"{(batch_index + 1) * self.batch_size - 1} on {size} nodes with edge probability "
+                              f"{prob:0.3f} (seed {self.seed})")
+            self.batch = build_random_DAGs(self.batch_size, size, prob, self.arbitrary_demands,
+                                           self.max_incoming_edges, self.max_outgoing_edges, rng)
+            self.batch_index = batch_index
+        return self.batch[index % self.batch_size]
+
+
+def _flow_edges(solution: ECMP_Sol):
+    """ The edges that carry flow, they identify the effective sub-DAG of an ECMP solution """
+    return frozenset(edge for edge, load in get_edge_loads(solution.dag).items() if load > 0)
+
 
 class ConjectureManager:
     conjectures_to_check = []
     checking_type = CHECK_ON_OPTIMAL_SUB_DAGS_ONLY
     forwarding_type = ECMP_FORWARDING
     exit_on_counterexample = True
+    lp_formulation = PATH_FORMULATION
+    lp_backend = DEFAULT_BACKEND
+    optimal_sub_DAG_search = BRANCH_AND_BOUND
+    batch_size = None
+    gray_code_order = False
+    solution_store: SolutionStore = None
+    render_graphs = True
+    preprocess_instances = True
+    # ECMP to optimal congestion ratio of the last verified instance, the feedback of SearchInstanceGenerator
+    last_ratio = None
 
     @classmethod
     def setup(cls,
               checking_type=CHECK_ON_OPTIMAL_SUB_DAGS_ONLY,
               forwarding_type=ECMP_FORWARDING,
-              exit_on_counterexample=True
+              exit_on_counterexample=True,
+              lp_formulation=PATH_FORMULATION,
+              lp_backend=DEFAULT_BACKEND,
+              optimal_sub_DAG_search=BRANCH_AND_BOUND,
+              batch_size=None,
+              gray_code_order=False,
+              solution_store: SolutionStore = None,
+              render_graphs=True,
+              preprocess_instances=True
               ):
         cls.checking_type = checking_type
         cls.forwarding_type = forwarding_type
         cls.exit_on_counterexample = exit_on_counterexample
+        cls.lp_formulation = lp_formulation
+        cls.lp_backend = lp_backend
+        cls.optimal_sub_DAG_search = optimal_sub_DAG_search
+        cls.batch_size = batch_size
+        cls.gray_code_order = gray_code_order
+        cls.solution_store = solution_store
+        cls.render_graphs = render_graphs
+        set_render_graphs(render_graphs)
+        cls.preprocess_instances = preprocess_instances
 
     @classmethod
     def register(cls, *conj):
         cls.conjectures_to_check.extend(conj)
 
     @classmethod
-    def _check_all_conjectures(cls, opt_solution: Solution, ecmp_solutions: list[ECMP_Sol], inst: Instance, index: int):
+    def _check_all_conjectures(cls, context: MetricsContext, index: int):
         return all(
-            conj.check(opt_solution, ecmp_solutions, inst, index)
+            conj.check(context, index)
             for conj in cls.conjectures_to_check
         )
 
     @classmethod
-    def _check_conjectures_for_every_sub_DAG(cls, opt_solution: Solution, inst: Instance, index: int) -> ECMP_Sol:
+    def _iterate_candidates(cls, opt_solution: Solution, inst: Instance):
+        """
+            All effective sub-DAGs, each once, starting with the promising ones that have optimal equal-splitting
+            congestion. The full enumeration skips the promising ones, which it finds again.
+        """
+        if cls.forwarding_type == INTEGRAL_FORWARDING:
+            promising = get_ALL_optimal_single_forwarding_DAGs(opt_solution.dag, inst, cls.optimal_sub_DAG_search)
+        else:
+            promising = get_ALL_optimal_ECMP_sub_DAGs(opt_solution.dag, inst, cls.optimal_sub_DAG_search)
+
+        # several sub-DAGs can share an effective sub-DAG, so the promising ones may repeat as well
+        seen = dict()
+        for result in promising:
+            seen.setdefault(_flow_edges(result), result)
+        if not seen:
+            return iterate_ecmp_solutions(opt_solution.dag, inst, cls.forwarding_type, cls.batch_size,
+                                          cls.gray_code_order)
+
+        # the engines may round differently, only candidates with (nearly) optimal congestion can be promising ones
+        optimum = promising[0].congestion
+        remaining = (
+            result for result in iterate_ecmp_solutions(
+                opt_solution.dag, inst, cls.forwarding_type, cls.batch_size, cls.gray_code_order
+            )
+            if not math.isclose(result.congestion, optimum) or _flow_edges(result) not in seen
+        )
+        return itertools.chain(seen.values(), remaining)
+
+    @classmethod
+    def _check_conjectures_for_every_sub_DAG(cls, opt_solution: Solution, inst: Instance, index: int):
+        """
+            Searches for a sub-DAG that satisfies all conjectures and stops at the first one.
+            The cheapest conjectures (by measured cost) are checked first, so they reject candidates early.
+
+            Returns:
+                    The witness ECMP_Sol (or None), the number of candidates examined, the time spent checking them
+                    and the lowest congestion among them
+        """
+        conjectures = sorted(cls.conjectures_to_check, key=lambda conj: conj.cost)
+        optimal = FlowMetrics(opt_solution, inst)
         solution = None
+        examined = 0
+        check_time = 0.0
+        best_congestion = None
         verbose = Conjecture.VERBOSE
         Conjecture.VERBOSE = False
-        for sub_dag in iterate_sub_DAG(opt_solution.dag, mode=cls.forwarding_type):
-            result = get_ecmp_DAG(sub_dag, inst)
-            if cls._check_all_conjectures(opt_solution, [result], inst, index):
+        for result in cls._iterate_candidates(opt_solution, inst):
+            examined += 1
+            if best_congestion is None or result.congestion < best_congestion:
+                best_congestion = result.congestion
+            context = MetricsContext(opt_solution, [result], inst, optimal)
+            start = time.perf_counter()
+            satisfied = all(conj.check(context, index) for conj in conjectures)
+            check_time += time.perf_counter() - start
+            if satisfied:
                 solution = result
+                break
         Conjecture.VERBOSE = verbose
-        return solution
+        return solution, examined, check_time, best_congestion
 
     @classmethod
     def _check_on_optimal_only(cls, opt_solution: Solution, inst: Instance, index: int):
         logger = get_logger()
-        ecmp_time, ecmp_solutions = time_execution(get_ALL_optimal_ECMP_sub_DAGs, opt_solution.dag, inst)
-        logger.info(f"Calculated optimal ECMP sub-DAGs\t{f'  ({ecmp_time:0.2f}s)' if ecmp_time > 1 else ''}")
+        ecmp_solutions = None
+        if cls.solution_store is not None:
+            ecmp_solutions = cls.solution_store.get_ecmp_solutions(inst)
+
+        metrics = get_metrics()
+        num_nodes = inst.dag.num_nodes
+        if ecmp_solutions is None:
+            ecmp_time, ecmp_solutions = time_execution(
+                get_ALL_optimal_ECMP_sub_DAGs, opt_solution.dag, inst, cls.optimal_sub_DAG_search
+            )
+            metrics.observe_stage("sub_DAG_enumeration", ecmp_time, nodes=num_nodes)
+            logger.info(f"Calculated optimal ECMP sub-DAGs\t{f'  ({ecmp_time:0.2f}s)' if ecmp_time > 1 else ''}")
+            if cls.solution_store is not None and ecmp_solutions:
+                cls.solution_store.put_ecmp_solutions(inst, ecmp_solutions)
+        else:
+            logger.info("Loaded optimal ECMP sub-DAGs from store")
 
         if not ecmp_solutions:
-            show_graph(inst, f"ex_{index}", opt_solution.dag)
-            save_instance("failures", inst, index)
+            name = unique_name(f"failures/ex_{index}")
+            write_graph(inst, name, opt_solution.dag)
+            write_pickle(name, inst)
             logger.error("There was an error. The optimal ECMP solution could be calculated. "
-                         f"Check the failures/ex_{index} files. Exiting.")
+                         f"Check the {name} files. Exiting.")
             exit(1)
 
+        cls.last_ratio = min(ecmp.congestion for ecmp in ecmp_solutions) / opt_solution.opt_congestion
         verification_time, solution = time_execution(
-            cls._check_all_conjectures, opt_solution, ecmp_solutions, inst, index
+            cls._check_all_conjectures, MetricsContext(opt_solution, ecmp_solutions, inst), index
         )
+        metrics.observe_stage("conjecture_checks", verification_time, nodes=num_nodes)
 
         if solution:
             logger.info(f"Verified all conjectures for optimal ECMP DAGs"
@@ -102,27 +392,86 @@ class ConjectureManager:
     @classmethod
     def _check_on_all_sub_DAGs(cls, opt_solution: Solution, inst: Instance, index: int):
         logger = get_logger()
-        ecmp_time, solution = time_execution(cls._check_conjectures_for_every_sub_DAG, opt_solution, inst, index)
+        ecmp_time, (solution, examined, check_time, best_congestion) = time_execution(
+            cls._check_conjectures_for_every_sub_DAG, opt_solution, inst, index
+        )
+        if best_congestion is not None:
+            cls.last_ratio = best_congestion / opt_solution.opt_congestion
+        num_sub_DAGs = count_sub_DAGs(opt_solution.dag, cls.forwarding_type)
+        num_effective = count_effective_sub_DAGs(opt_solution.dag, inst, cls.forwarding_type)
+
+        metrics = get_metrics()
+        num_nodes = inst.dag.num_nodes
+        metrics.observe_stage("sub_DAG_enumeration", max(ecmp_time - check_time, 0), nodes=num_nodes)
+        metrics.observe_stage("conjecture_checks", check_time, nodes=num_nodes)
+        metrics.observe("sub_DAG_candidates", num_sub_DAGs)
+        metrics.observe("effective_sub_DAG_candidates", num_effective)
+        metrics.observe("sub_DAGs_examined", examined)
 
         if solution is not None:
-            logger.info(f"Verified all conjectures across all sub-DAGs"
+            logger.info(f"Verified all conjectures across all sub-DAGs "
+                        f"(examined {examined} of {num_effective} effective / {num_sub_DAGs} raw candidates)"
                         f"\t{f'  ({ecmp_time:0.2f}s)' if ecmp_time > 1 else ''}")
             return True
 
+        logger.info(f"No sub-DAG satisfies all conjectures (examined {examined} candidates, {num_effective} effective "
+                    f"of {num_sub_DAGs} raw)")
+
         return False
 
     @classmethod
-    def verify_instance(cls, inst: Instance, index: int, show_results=False):
+    def _solve_reduced(cls, inst: Instance):
+        """ Solves the reduced instance (see preprocessing.py), the solution is in the original node ids """
+        logger = get_logger()
+        with get_metrics().time_stage("preprocessing", nodes=inst.dag.num_nodes):
+            reduction = reduce_instance(inst)
+        if reduction.unreachable_sources:
+            logger.info(f"Sources {reduction.unreachable_sources} cannot reach the target")
+            return None
+
+        get_metrics().observe("reduced_nodes", reduction.instance.dag.num_nodes)
+        logger.info(f"Reduced instance from {inst.dag.num_nodes} to {reduction.instance.dag.num_nodes} nodes "
+                    f"({len(reduction.chains)} contracted chains)")
+        return calculate_reduced_solution(inst, reduction, cls.lp_formulation, cls.lp_backend)
+
+    @classmethod
+    def get_optimal_solution(cls, inst: Instance):
+        """ Looks up the optimal solution in the solution store and only solves the LP on a miss """
         logger = get_logger()
-        sol_time, opt_solution = time_execution(calculate_optimal_solution, inst)
+        if cls.solution_store is not None:
+            found, opt_solution = cls.solution_store.get(inst)
+            if found:
+                logger.info("Loaded optimal solution from store")
+                return opt_solution
+
+        if cls.preprocess_instances:
+            sol_time, opt_solution = time_execution(cls._solve_reduced, inst)
+        else:
+            sol_time, opt_solution = time_execution(
+                calculate_optimal_solution, inst, cls.lp_formulation, cls.lp_backend
+            )
         logger.info(f"Calculated optimal solution\t{f'({sol_time:0.2f}s)' if sol_time > 1 else ''}")
 
+        if cls.solution_store is not None:
+            cls.solution_store.put(inst, opt_solution, cls.lp_formulation, cls.lp_backend)
+
+        return opt_solution
+
+    @classmethod
+    def verify_instance(cls, inst: Instance, index: int, show_results=False):
+        logger = get_logger()
+        cls.last_ratio = None
+        metrics = get_metrics()
+        metrics.observe("instance_nodes", inst.dag.num_nodes)
+        metrics.observe("instance_edges", sum(len(inst.dag.neighbors[node]) for node in range(inst.dag.num_nodes)))
+        opt_solution = cls.get_optimal_solution(inst)
+
         if opt_solution is None:
             logger.info("-> Infeasible Instance!")
             return True
 
         if show_results:
-            show_graph(inst, f"output_{index}", opt_solution.dag)
+            write_graph(inst, unique_name(f"output_{index}"), opt_solution.dag)
 
         if cls.checking_type == CHECK_ON_OPTIMAL_SUB_DAGS_ONLY:
             return cls._check_on_optimal_only(opt_solution, inst, index)
@@ -132,21 +481,51 @@ class ConjectureManager:
         raise RuntimeError("Invalid value for verification_type.")
 
 
-def run_single_test_suite(generator: InstanceGenerator, num_iterations=100, show_results=False, log_to_stdout=True):
+def run_single_test_suite(generator: InstanceGenerator, num_iterations=100, show_results=False, log_to_stdout=True,
+                          checkpoint: Checkpointer = None, resume=False):
+    """
+        Verifies num_iterations instances in this process and exits at the first counterexample.
+        With a checkpoint, the progress is saved periodically and on exit. With resume, a saved generator
+        replaces the given one and the run continues after the last saved instance.
+    """
     setup_logger(log_to_stdout)
     logger = get_logger()
-
-    for i in range(num_iterations):
-        logger.info("-" * 72)
-        logger.info(f"Begin Iteration {i + 1}:")
-        inst = next(generator)
-        success = ConjectureManager.verify_instance(inst, i, show_results=show_results)
-        if not success:
-            logger.error("=" * 50)
-            logger.error(f"  !!! {multiprocessing.current_process().name} FOUND A COUNTER EXAMPLE !!!")
-            logger.error("=" * 50)
-            exit(0)
-
+    worker = multiprocessing.current_process().name
+
+    statistics = SuiteStatistics()
+    saved = checkpoint.load() if checkpoint is not None and resume else None
+    if saved is not None:
+        generator, statistics = saved.generator, saved.statistics
+        logger.info(f"Resuming from {checkpoint.path} after {statistics.num_instances} instances")
+
+    with OutputWriter(ConjectureManager.render_graphs):
+        while statistics.num_instances < num_iterations:
+            logger.info("-" * 72)
+            logger.info(f"Begin Iteration {statistics.num_instances + 1}:")
+            inst = next(generator)
+            start = time.time()
+            success = ConjectureManager.verify_instance(inst, generator.last_index, show_results=show_results)
+            statistics.add(InstanceResult(generator.last_index, success, time.time() - start, worker, None,
+                                          ConjectureManager.last_ratio))
+            generator.report(generator.last_index, ConjectureManager.last_ratio)
+            get_metrics().maybe_export()
+            if checkpoint is not None:
+                if success:
+                    checkpoint.maybe_save(generator, statistics)
+                else:
+                    checkpoint.save(generator, statistics)
+            if not success:
+                get_metrics().export()
+                logger.error("=" * 50)
+                logger.error(f"  !!! {multiprocessing.current_process().name} FOUND A COUNTER EXAMPLE !!!")
+                logger.error("=" * 50)
+                exit(0)
+
+    get_metrics().export()
+    if checkpoint is not None:
+        checkpoint.save(generator, statistics)
+    logger.info(str(statistics))
+    logger.info(f"Skipped {generator.num_duplicates} duplicate instances")
     logger.info("")
     logger.info("=" * 40)
     logger.info(" " * 15 + "SUCCESS!!" + " " * 15)
@@ -155,22 +534,296 @@ def run_single_test_suite(generator: InstanceGenerator, num_iterations=100, show
     print(f"{multiprocessing.current_process().name} terminated - no counterexample found!")
 
 
-def run_multiprocessing_suite(generator: InstanceGenerator, num_processes, num_iterations):
-    procs = []
-    for i in range(min(num_processes, 8)):
-        proc = Process(target=run_single_test_suite, args=(generator, num_iterations, False, False))
-        procs.append(proc)
-        proc.start()
+InstanceResult = namedtuple("InstanceResult", "index, success, duration, worker, error, ratio", defaults=(None,))
+# sent by a pool worker when it begins a chunk, so the parent knows which instances a dead worker took with it
+ChunkStarted = namedtuple("ChunkStarted", "chunk, worker, pid")
+# how long the parent waits for a result before it looks for dead workers
+LIVENESS_INTERVAL = 1.0
+
+
+class SuiteStatistics:
+    """ Aggregates the per-instance results of a test suite """
+
+    def __init__(self):
+        self.num_instances = 0
+        self.num_errors = 0
+        self.counterexamples = []
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def add(self, result: InstanceResult):
+        self.num_instances += 1
+        self.total_time += result.duration
+        self.max_time = max(self.max_time, result.duration)
+        if result.error is not None:
+            self.num_errors += 1
+        elif not result.success:
+            self.counterexamples.append(result.index)
+
+    def __str__(self):
+        avg_time = self.total_time / self.num_instances if self.num_instances else 0
+        return f"{self.num_instances} instances checked, {len(self.counterexamples)} counterexamples, " \
+               f"{self.num_errors} errors, {avg_time:0.3f}s avg / {self.max_time:0.2f}s max per instance"
+
+
+_result_pipe = None
+_result_lock = None
+
+
+def _init_worker(result_pipe, result_lock, log_to_stdout):
+    global _result_pipe, _result_lock
+    _result_pipe, _result_lock = result_pipe, result_lock
+    setup_logger(log_to_stdout)
+
+
+def _send_to_parent(message):
+    # written right away, unlike a multiprocessing.Queue whose feeder thread would die with a crashing worker
+    with _result_lock:
+        _result_pipe.send(message)
+
+
+def _verify_task(index: int, inst: Instance, worker: str) -> InstanceResult:
+    """ Verifies one instance, an exception (or exit) is reported as the error of the result """
+    logger = get_logger()
+    logger.info("-" * 72)
+    logger.info(f"Begin Iteration {index + 1}:")
+    start = time.time()
+    try:
+        success, error = ConjectureManager.verify_instance(inst, index), None
+    except (Exception, SystemExit) as e:
+        logger.exception(f"Verification of instance {index} failed")
+        success, error = None, repr(e)
+    return InstanceResult(index, success, time.time() - start, worker, error,
+                          ConjectureManager.last_ratio if error is None else None)
+
+
+def _verify_chunk(chunk_id: int, chunk: list):
+    worker = multiprocessing.current_process().name
+    _send_to_parent(ChunkStarted(chunk_id, worker, os.getpid()))
+    for position, (index, inst) in enumerate(chunk):
+        result = _verify_task(index, inst, worker)
+        # export before reporting, the parent may read the metrics or terminate the pool as soon as it sees the
+        # last result or a counterexample
+        if not result.success or position == len(chunk) - 1:
+            get_metrics().export()
+        else:
+            get_metrics().maybe_export()
+        _send_to_parent(result)
+
+
+def _generate_tasks(generator: InstanceGenerator, num_instances: int):
+    for _ in range(num_instances):
+        inst = next(generator)
+        yield generator.last_index, inst
+
+
+def _chunked(tasks, chunk_size: int):
+    chunk = []
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _run_pool(tasks, num_processes, chunk_size: int, log_to_stdout: bool, on_result=None,
+              statistics: SuiteStatistics = None) -> SuiteStatistics:
+    """
+        Verifies the (index, instance) tasks on a pool of worker processes. The tasks are handed out in chunks,
+        at most two chunks per worker are in flight at any time, so slow instances never block the others.
+        Every worker reports each instance back to the parent as soon as it is verified.
+        The stage metrics of all workers are merged into output/metrics/all.json afterwards.
+        If exit_on_counterexample is set, the first counterexample terminates the whole pool.
+        The instances of a worker process that dies are reported as errors.
+        on_result is called with every InstanceResult, before further tasks are generated.
+        The results are added to statistics, a new SuiteStatistics if None.
+    """
+    logger = get_logger()
+
+    num_processes = num_processes or os.cpu_count()
+    chunks = _chunked(tasks, chunk_size)
+    statistics = statistics if statistics is not None else SuiteStatistics()
+
+    # every worker exports its stage metrics to output/metrics, see stage_metrics.py
+    clear_metrics()
+
+    ctx = multiprocessing.get_context("fork")
+    result_reader, result_pipe = ctx.Pipe(duplex=False)
+    # the workers are forked after the writer is open, so they hand their graphs and pickles to it
+    with OutputWriter(ConjectureManager.render_graphs), \
+            ctx.Pool(num_processes, initializer=_init_worker,
+                     initargs=(result_pipe, ctx.Lock(), log_to_stdout)) as pool:
+        chunk_ids = itertools.count()
+        # index -> chunk id of every instance that was handed out but not reported yet
+        chunk_of = dict()
+        # chunk id -> its unreported indices, its AsyncResult, the ChunkStarted of its worker, its exception
+        unreported, async_results, started, errors = dict(), dict(), dict(), dict()
+
+        def submit_chunks():
+            while len(chunk_of) < 2 * num_processes * chunk_size:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                chunk_id = next(chunk_ids)
+                unreported[chunk_id] = {index for index, _ in chunk}
+                chunk_of.update((index, chunk_id) for index, _ in chunk)
+                async_results[chunk_id] = pool.apply_async(
+                    _verify_chunk, (chunk_id, chunk),
+                    error_callback=lambda e, failed=chunk_id: errors.setdefault(failed, repr(e)))
+
+        def report(result: InstanceResult):
+            """ Returns whether the pool has to stop """
+            chunk_id = chunk_of.pop(result.index, None)
+            if chunk_id is None:
+                # the instance was already reported as lost
+                return False
+            unreported[chunk_id].discard(result.index)
+            if not unreported[chunk_id]:
+                for chunk_state in (unreported, async_results, started, errors):
+                    chunk_state.pop(chunk_id, None)
+
+            statistics.add(result)
+            if on_result is not None:
+                on_result(result)
+
+            if result.error is not None:
+                logger.error(f"{result.worker} failed on instance {result.index}: {result.error}")
+            elif not result.success:
+                logger.error("=" * 50)
+                logger.error(f"  !!! {result.worker} FOUND A COUNTER EXAMPLE (instance {result.index}) !!!")
+                logger.error("=" * 50)
+                return ConjectureManager.exit_on_counterexample
+            return False
+
+        def report_lost():
+            """
+                Reports the unreported instances of every chunk whose worker died or that ended without all of its
+                results as errors. The pool replaces a dead worker but never completes its chunk.
+            """
+            alive = {process.pid for process in multiprocessing.active_children()}
+            for chunk_id in list(unreported):
+                if chunk_id in started and started[chunk_id].pid not in alive:
+                    error = "the worker process died"
+                elif async_results[chunk_id].ready():
+                    error = errors.get(chunk_id, "the chunk ended without all of its results")
+                else:
+                    continue
+                worker = started[chunk_id].worker if chunk_id in started else None
+                for index in sorted(unreported[chunk_id]):
+                    report(InstanceResult(index, None, 0.0, worker, error))
+
+        submit_chunks()
+        while chunk_of:
+            if not result_reader.poll(LIVENESS_INTERVAL):
+                report_lost()
+            else:
+                message = result_reader.recv()
+                if isinstance(message, ChunkStarted):
+                    started[message.chunk] = message
+                elif report(message):
+                    pool.terminate()
+                    break
+            submit_chunks()
+
+    logger.info(str(statistics))
+    metrics = read_metrics()
+    metrics.export()
+    for line in metrics.stage_summary():
+        logger.info(line)
+    return statistics
+
+
+def run_multiprocessing_suite(generator: InstanceGenerator, num_processes=None, num_iterations=100, chunk_size=16,
+                              log_to_stdout=False, checkpoint: Checkpointer = None, resume=False):
+    """
+        Verifies num_processes * num_iterations instances on a pool of worker processes.
+        The parent generates the instances, see _run_pool for the scheduling. The workers keep no state, so the
+        parent checkpoints the whole campaign: the generator, the statistics and the instances still in flight.
+
+        Parameters:
+                generator (InstanceGenerator): The source of the instances
+                num_processes (int | None): The number of workers, defaults to the number of cores
+                num_iterations (int): The number of instances per worker
+                chunk_size (int): The number of instances per task
+                log_to_stdout (bool): Also log to stdout
+                checkpoint (Checkpointer | None): Saves the progress periodically and at the end
+                resume (bool): Continue from the saved checkpoint, whose generator replaces the given one.
+                    The instances that were in flight are verified again first.
+
+        Returns:
+                The SuiteStatistics of the run, including the instances before the resume
+    """
+    setup_logger(log_to_stdout)
+    logger = get_logger()
+
+    num_processes = num_processes or os.cpu_count()
+    statistics = SuiteStatistics()
+    pending = dict()
+    saved = checkpoint.load() if checkpoint is not None and resume else None
+    if saved is not None:
+        generator, statistics, pending = saved.generator, saved.statistics, dict(saved.pending)
+        logger.info(f"Resuming from {checkpoint.path} after {statistics.num_instances} instances, "
+                    f"{len(pending)} were in flight")
+
+    num_new = max(num_processes * num_iterations - statistics.num_instances - len(pending), 0)
+    tasks = itertools.chain(list(pending.items()), _generate_tasks(generator, num_new))
+
+    def track(task_source):
+        for index, inst in task_source:
+            pending[index] = inst
+            yield index, inst
+
+    def on_result(result: InstanceResult):
+        pending.pop(result.index, None)
+        generator.report(result.index, result.ratio)
+        if checkpoint is not None:
+            checkpoint.maybe_save(generator, statistics, pending.items())
+
+    statistics = _run_pool(track(tasks), num_processes, chunk_size, log_to_stdout, on_result, statistics)
+    if checkpoint is not None:
+        checkpoint.save(generator, statistics, pending.items())
+
+    logger.info(f"Skipped {generator.num_duplicates} duplicate instances")
+    print(statistics)
+    return statistics
+
+
+def run_replay_suite(store: SolutionStore, num_processes=None, chunk_size=64, log_to_stdout=False):
+    """
+        Re-checks the registered conjectures on every feasible instance of a solution store, without solving any LP.
+        The stored optimal ECMP sub-DAGs are reused as well where the store has them. Instances are identified by
+        their row in the store.
+
+        Parameters:
+                store (SolutionStore): The corpus to replay
+                num_processes (int | None): The number of workers, defaults to the number of cores
+                chunk_size (int): The number of instances per task
+                log_to_stdout (bool): Also log to stdout
+
+        Returns:
+                The SuiteStatistics of the replay
+    """
+    setup_logger(log_to_stdout)
+    logger = get_logger()
+    logger.info(f"Replaying {store.path} with conjectures "
+                f"{', '.join(conj.name for conj in ConjectureManager.conjectures_to_check)}")
+
+    ConjectureManager.solution_store = store
+    statistics = _run_pool(store.iterate_instances(), num_processes, chunk_size, log_to_stdout)
 
-    for proc in procs:
-        proc.join()
+    print(statistics)
+    return statistics
 
 
-def inspect_instance(inst_id: int, folder: str):
-    with open(f"output/{folder}/ex_{inst_id}.pickle", "rb") as f:
+def inspect_instance(inst_id, folder: str):
+    """ inst_id is either the index of the instance or its file name without .pickle, e.g. ex_3_ForkPoolWorker-2 """
+    name = inst_id if isinstance(inst_id, str) else f"ex_{inst_id}"
+    with open(f"output/{folder}/{name}.pickle", "rb") as f:
         inst = pickle.load(f)
 
-        opt_sol = calculate_optimal_solution(inst)
+        opt_sol = ConjectureManager.get_optimal_solution(inst)
         print(f"Optimal Congestion: {opt_sol.opt_congestion:0.4f}")
         show_graph(inst, "_before", opt_sol.dag)
 
@@ -1,75 +1,241 @@
+import copy
 import logging
 import multiprocessing
 import os
 import pickle
 import sys
 import time
+from array import array
 from collections import namedtuple, defaultdict
 
 import random
 import graphviz
 
-DAG = namedtuple("DAG", "num_nodes, neighbors")
+# order is an optional cached topological order, set once a DAG is no longer modified (see with_topological_order)
+DAG = namedtuple("DAG", "num_nodes, neighbors, order", defaults=(None,))
 Instance = namedtuple("Instance", "dag, sources, target, demands")
 Solution = namedtuple("Solution", "dag, opt_congestion")
 ECMP_Sol = namedtuple("ECMP_Sol", "dag, congestion, loads")
 
-max_incoming_edges = 1000
-max_outgoing_edges = 2
 
-
-def build_random_DAG(num_nodes, prob_edge, arbitrary_demands=False):
+class _MaskedNeighbors:
+    __slots__ = ("base", "masks", "cache")
+
+    def __init__(self, base, masks: dict):
+        self.base = base
+        self.masks = masks
+        self.cache = dict()
+
+    def __getitem__(self, node):
+        if node not in self.masks:
+            return self.base[node]
+        if node not in self.cache:
+            mask = self.masks[node]
+            self.cache[node] = {
+                nb: val for i, (nb, val) in enumerate(self.base[node].items()) if mask >> i & 1
+            }
+        return self.cache[node]
+
+
+class SubDAG:
+    """
+        A lightweight view of a sub-DAG: the base DAG plus a bitmask of active out-edges for some nodes.
+        Bit i of masks[node] refers to the i-th neighbor of node in the base DAG, nodes without a mask keep
+        all their edges. It offers the same num_nodes and neighbors interface as DAG, so get_ecmp_DAG,
+        get_node_loads etc. accept it directly. Use to_DAG() to materialize results that are kept.
+        A topological order of the base DAG is also one of every sub-DAG, so the view shares the order of its base.
+    """
+    __slots__ = ("base", "masks", "num_nodes", "neighbors", "order")
+
+    def __init__(self, base: DAG, masks: dict, order=None):
+        self.base = base
+        self.masks = masks
+        self.num_nodes = base.num_nodes
+        self.neighbors = _MaskedNeighbors(base.neighbors, masks)
+        self.order = order if order is not None else getattr(base, "order", None)
+
+    def to_DAG(self) -> DAG:
+        dag = copy.deepcopy(self.base)
+        if self.order is not None:
+            dag = dag._replace(order=tuple(self.order))
+        for node, mask in self.masks.items():
+            for i, nb in enumerate(list(self.base.neighbors[node])):
+                if not mask >> i & 1:
+                    del dag.neighbors[node][nb]
+        return dag
+
+
+class _CSRNeighbors:
+    __slots__ = ("csr",)
+
+    def __init__(self, csr):
+        self.csr = csr
+
+    def __getitem__(self, node):
+        csr = self.csr
+        start, end = csr.offsets[node], csr.offsets[node + 1]
+        if csr.values is None:
+            return csr.targets[start:end].tolist()
+        return dict(zip(csr.targets[start:end], csr.values[start:end]))
+
+
+class CSRDAG:
+    """
+        A compact compressed sparse row representation of a DAG. The out-edges of node are the entries
+        offsets[node] to offsets[node + 1] - 1 of targets (and of values for flow DAGs, None for plain graphs).
+        The arrays are typed arrays and can be wrapped without copying by numpy (see arrays()).
+        order is the topological order, computed once when the DAG is built.
+        The neighbors attribute offers read-only access in the shape of DAG.neighbors, use to_DAG() to convert back.
+    """
+    __slots__ = ("num_nodes", "offsets", "targets", "values", "order")
+
+    def __init__(self, num_nodes: int, offsets, targets, values=None, order=None):
+        self.num_nodes = num_nodes
+        self.offsets = array("l", offsets)
+        self.targets = array("l", targets)
+        self.values = array("d", values) if values is not None else None
+        self.order = None
+        self.order = array("l", order if order is not None else topologicalSort(self))
+
+    @classmethod
+    def from_DAG(cls, dag: DAG):
+        offsets, targets, values = [0], [], []
+        has_values = False
+        neighbors = dag.neighbors
+        for node in range(dag.num_nodes):
+            # views such as SubDAG only support indexing, get keeps the defaultdict of a DAG unchanged
+            nbs = neighbors.get(node, ()) if isinstance(neighbors, dict) else neighbors[node]
+            targets.extend(nbs)
+            if isinstance(nbs, dict):
+                has_values = True
+                values.extend(nbs.values())
+            offsets.append(len(targets))
+        return cls(dag.num_nodes, offsets, targets, values if has_values else None, topologicalSort(dag))
+
+    @property
+    def neighbors(self):
+        return _CSRNeighbors(self)
+
+    @property
+    def num_edges(self):
+        return len(self.targets)
+
+    def to_DAG(self) -> DAG:
+        if self.values is None:
+            neighbors = defaultdict(list)
+        else:
+            neighbors = defaultdict(lambda: defaultdict(float))
+        for node in range(self.num_nodes):
+            start, end = self.offsets[node], self.offsets[node + 1]
+            if start == end:
+                continue
+            if self.values is None:
+                neighbors[node].extend(self.targets[start:end])
+            else:
+                neighbors[node].update(zip(self.targets[start:end], self.values[start:end]))
+        return DAG(self.num_nodes, neighbors)
+
+    def arrays(self):
+        """
+            Returns:
+                    numpy views of offsets, targets and values (or None) that share the memory of this DAG
+        """
+        import numpy as np
+        values = np.frombuffer(self.values, dtype=np.float64) if self.values is not None else None
+        return np.frombuffer(self.offsets, dtype=np.int_), np.frombuffer(self.targets, dtype=np.int_), values
+
+
+def as_csr(dag) -> CSRDAG:
+    return dag if isinstance(dag, CSRDAG) else CSRDAG.from_DAG(dag)
+
+
+# default degree limits of random instances, every generator can set its own
+DEFAULT_MAX_INCOMING_EDGES = 1000
+DEFAULT_MAX_OUTGOING_EDGES = 2
+
+
+def build_random_DAG(num_nodes, prob_edge, arbitrary_demands=False, rng=random,
+                     max_incoming_edges=DEFAULT_MAX_INCOMING_EDGES, max_outgoing_edges=DEFAULT_MAX_OUTGOING_EDGES):
+    max_incoming_edges = max_incoming_edges if max_incoming_edges is not None else num_nodes
+    max_outgoing_edges = max_outgoing_edges if max_outgoing_edges is not None else num_nodes
     edges = defaultdict(list)
     num_ingoing_edges = [0] * num_nodes
     num_outgoing_edges = [0] * num_nodes
 
     for start in range(num_nodes):
         for end in range(start + 1, num_nodes):
-            if random.random() < prob_edge \
+            if rng.random() < prob_edge \
                     and num_ingoing_edges[end] < max_incoming_edges \
                     and num_outgoing_edges[start] < max_outgoing_edges:
                 edges[start].append(end)
                 num_ingoing_edges[end] += 1
                 num_outgoing_edges[start] += 1
-            if random.random() < prob_edge \
+            if rng.random() < prob_edge \
                     and num_ingoing_edges[start] < max_incoming_edges \
                     and num_outgoing_edges[end] < max_outgoing_edges:
                 edges[end].append(start)
                 num_ingoing_edges[start] += 1
                 num_outgoing_edges[end] += 1
 
-    num_sources = random.randint(2, num_nodes - 2)
-    sources = random.sample(range(1, num_nodes - 1), num_sources)
-    demands = [random.randint(1, num_nodes) for _ in range(len(sources))] if arbitrary_demands else [1] * len(sources)
+    num_sources = rng.randint(2, num_nodes - 2)
+    sources = rng.sample(range(1, num_nodes - 1), num_sources)
+    demands = [rng.randint(1, num_nodes) for _ in range(len(sources))] if arbitrary_demands else [1] * len(sources)
     return Instance(DAG(num_nodes, edges), sources, 0, demands)
 
 
-def topologicalSortUtil(dag: DAG, node: int, visited, stack):
-    visited[node] = True
-
-    for nb in dag.neighbors[node]:
-        if not visited[nb]:
-            topologicalSortUtil(dag, nb, visited, stack)
-
-    stack.append(node)
-
-
 def topologicalSort(dag: DAG):
+    """
+        Returns:
+                The cached order of the DAG if it has one. Otherwise the reversed DFS finishing order, computed
+                with an explicit stack so that it also works for DAGs deeper than the recursion limit.
+    """
+    order = getattr(dag, "order", None)
+    if order is not None and len(order) == dag.num_nodes:
+        return order
+
     visited = [False] * dag.num_nodes
     stack = []
 
     for i in range(dag.num_nodes):
-        if not visited[i]:
-            topologicalSortUtil(dag, i, visited, stack)
+        if visited[i]:
+            continue
+        visited[i] = True
+        path = [(i, iter(dag.neighbors[i]))]
+        while path:
+            node, nbs = path[-1]
+            for nb in nbs:
+                if not visited[nb]:
+                    visited[nb] = True
+                    path.append((nb, iter(dag.neighbors[nb])))
+                    break
+            else:
+                path.pop()
+                stack.append(node)
 
     return reversed(stack)
 
 
+def with_topological_order(dag: DAG) -> DAG:
+    """
+        Returns:
+                The DAG with its topological order cached. It is then shared by every SubDAG view, ECMP flow and
+                load computation on this DAG, so the DAG must not be modified anymore.
+    """
+    return dag._replace(order=tuple(topologicalSort(dag)))
+
+
 def get_node_loads(dag: DAG, inst: Instance):
     node_loads = [0] * inst.dag.num_nodes
     for s, d in zip(inst.sources, inst.demands):
         node_loads[s] = d
 
+    if isinstance(dag, CSRDAG):
+        offsets, targets, values = dag.offsets, dag.targets, dag.values
+        for node in dag.order:
+            for e in range(offsets[node], offsets[node + 1]):
+                node_loads[targets[e]] += values[e]
+        return node_loads
+
     for node in topologicalSort(dag):
         for nb in dag.neighbors[node]:
             node_loads[nb] += dag.neighbors[node][nb]
@@ -80,6 +246,13 @@ def get_node_loads(dag: DAG, inst: Instance):
 def get_edge_loads(dag: DAG):
     edge_loads = defaultdict(float)
 
+    if isinstance(dag, CSRDAG):
+        offsets, targets, values = dag.offsets, dag.targets, dag.values
+        for node in dag.order:
+            for e in range(offsets[node], offsets[node + 1]):
+                edge_loads[(node, targets[e])] += values[e]
+        return edge_loads
+
     for node in topologicalSort(dag):
         for nb in dag.neighbors[node]:
             edge = (node, nb)
@@ -90,10 +263,10 @@ def get_edge_loads(dag: DAG):
 
 def instance_to_dot(instance: Instance, solution: DAG = None):
     dot = graphviz.Digraph('ecmp-test', comment='ECMP Test')
-    dot.node(str(0), "target", color="red")
+    dot.node(str(instance.target), "target", color="red")
     node_loads = get_node_loads(solution, instance)
-    for node in range(1, instance.dag.num_nodes):
-        if len(instance.dag.neighbors[node]) > 0:
+    for node in range(instance.dag.num_nodes):
+        if node != instance.target and len(instance.dag.neighbors[node]) > 0:
             load_label = f"{node_loads[node]:.2f}".rstrip("0").rstrip(".")
             dot.node(str(node), str(node), color="blue" if node in instance.sources else "black", xlabel=load_label)
 
@@ -0,0 +1,93 @@
+from model import *
+
+
+def _copy_instance(inst: Instance) -> Instance:
+    edges = defaultdict(list)
+    for node in range(inst.dag.num_nodes):
+        if inst.dag.neighbors[node]:
+            edges[node] = list(inst.dag.neighbors[node])
+    return Instance(DAG(inst.dag.num_nodes, edges), list(inst.sources), inst.target, list(inst.demands))
+
+
+def add_edge(inst: Instance, rng, max_incoming_edges=DEFAULT_MAX_INCOMING_EDGES,
+             max_outgoing_edges=DEFAULT_MAX_OUTGOING_EDGES):
+    """ Adds a random missing edge within the degree limits (None for no limit), in place """
+    n = inst.dag.num_nodes
+    neighbors = inst.dag.neighbors
+    in_degree = [0] * n
+    for node in range(n):
+        for nb in neighbors[node]:
+            in_degree[nb] += 1
+
+    def allowed(start, end):
+        return start != end and end not in neighbors[start] \
+            and (max_outgoing_edges is None or len(neighbors[start]) < max_outgoing_edges) \
+            and (max_incoming_edges is None or in_degree[end] < max_incoming_edges)
+
+    # random pairs first, only nearly saturated graphs need the full list of candidates
+    for _ in range(4 * n):
+        start, end = rng.randrange(n), rng.randrange(n)
+        if allowed(start, end):
+            neighbors[start].append(end)
+            return True
+
+    candidates = [(start, end) for start in range(n) for end in range(n) if allowed(start, end)]
+    if not candidates:
+        return False
+    start, end = rng.choice(candidates)
+    neighbors[start].append(end)
+    return True
+
+
+def remove_edge(inst: Instance, rng):
+    edges = [(node, j) for node in range(inst.dag.num_nodes) for j in range(len(inst.dag.neighbors[node]))]
+    if not edges:
+        return False
+    node, j = rng.choice(edges)
+    del inst.dag.neighbors[node][j]
+    return True
+
+
+def move_source(inst: Instance, rng):
+    """ Moves the demand of a random source to a node that is neither a source nor the target """
+    free = [node for node in range(inst.dag.num_nodes) if node != inst.target and node not in inst.sources]
+    if not free:
+        return False
+    inst.sources[rng.randrange(len(inst.sources))] = rng.choice(free)
+    return True
+
+
+def change_demand(inst: Instance, rng, max_demand=None):
+    max_demand = inst.dag.num_nodes if max_demand is None else max_demand
+    i = rng.randrange(len(inst.sources))
+    demand = rng.randint(1, max_demand)
+    if demand == inst.demands[i]:
+        return False
+    inst.demands[i] = demand
+    return True
+
+
+def mutate_instance(inst: Instance, rng, num_mutations=1, arbitrary_demands=True,
+                    max_incoming_edges=DEFAULT_MAX_INCOMING_EDGES, max_outgoing_edges=DEFAULT_MAX_OUTGOING_EDGES):
+    """
+        Applies num_mutations random mutations to a copy of the instance: adding or removing an edge, moving a
+        source or, with arbitrary_demands, changing a demand. The number of nodes and the target stay the same.
+
+        Returns:
+                The mutated copy
+    """
+    mutations = [
+        lambda child: add_edge(child, rng, max_incoming_edges, max_outgoing_edges),
+        lambda child: remove_edge(child, rng),
+        lambda child: move_source(child, rng),
+    ]
+    if arbitrary_demands:
+        mutations.append(lambda child: change_demand(child, rng))
+
+    child = _copy_instance(inst)
+    applied = 0
+    # a mutation may not apply, e.g. removing an edge from an empty graph, but every instance has some that do
+    while applied < num_mutations:
+        if rng.choice(mutations)(child):
+            applied += 1
+    return child
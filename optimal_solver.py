@@ -1,9 +1,6 @@
-import pickle
-
 from model import *
-
-import gurobipy as gp
-from gurobipy import GRB
+from lp_backends import LinearProgram, get_backend, DEFAULT_BACKEND
+from stage_metrics import get_metrics
 
 
 def _rec_generate_all_paths(G: DAG, node: int, target: int, visited: list, edge_dict: dict, path: list):
@@ -26,61 +23,68 @@ def generate_all_paths(G: DAG, source: int, target: int, edge_dict: dict):
     yield from _rec_generate_all_paths(G, source, target, visited, edge_dict, [source])
 
 
-def _rec_find_cycles(G: DAG, node, visited, cycle):
-    visited[node] = True
-    cycle.append(node)
-
-    for nb in G.neighbors[node]:
-        if not visited[nb]:
-            c = _rec_find_cycles(G, nb, visited, cycle)
-            if c is not None:
-                return c
-        elif nb in cycle:
-            return cycle[cycle.index(nb):]
-
-    cycle.remove(node)
-    return None
-
+def _cancel_cycle(G: DAG, cycle: list):
+    """
+        Subtracts the smallest flow on the cycle from all of its edges and deletes the edges that become empty.
 
-def _remove_cycle(G: DAG, cycle):
-    val = G.num_nodes
-    for i in range(len(cycle)):
-        from_id = cycle[i]
-        to_id = cycle[(i + 1) % len(cycle)]
-        if to_id not in G.neighbors[from_id]:
-            return
-        val = min(val, G.neighbors[from_id][to_id])
+        Returns:
+                The position in cycle of the tail of the first deleted edge
+    """
+    edges = [(cycle[i], cycle[(i + 1) % len(cycle)]) for i in range(len(cycle))]
+    val = min(G.neighbors[from_id][to_id] for from_id, to_id in edges)
 
-    for i in range(len(cycle)):
-        from_id = cycle[i]
-        to_id = cycle[(i + 1) % len(cycle)]
+    first_deleted = None
+    for i, (from_id, to_id) in enumerate(edges):
         G.neighbors[from_id][to_id] -= val
         if G.neighbors[from_id][to_id] < 1e-15:
             del G.neighbors[from_id][to_id]
+            if first_deleted is None:
+                first_deleted = i
+    return first_deleted
 
 
 def remove_cycles(graph: DAG):
-    count = 0
-
-    def check_from_all_nodes():
-        visited = [False] * graph.num_nodes
-        for node in range(graph.num_nodes):
-            if not visited[node]:
-                cycle = _rec_find_cycles(graph, node, visited, [])
-                if cycle is not None:
-                    _remove_cycle(graph, cycle)
-                    return True
-        return False
-
-    while check_from_all_nodes():
-        count += 1
-        if count > 100:
-            with open(f"output/progr_error/graph.pickle", "wb") as f:
-                pickle.dump(graph, f, pickle.HIGHEST_PROTOCOL)
-            with open(f"output/progr_error/graph.txt", "w") as f:
-                f.write("Could not remove all cycles!")
-
-    check_from_all_nodes()
+    """
+        Cancels all flow cycles of the graph in place within a single DFS. When the DFS closes a cycle, the cycle is
+        cancelled and the DFS backs up to the tail of its first deleted edge, the nodes behind it are visited again
+        later. Every cancellation deletes an edge, so this takes O(|V| * |E|) time at most.
+        Cancelling a cycle only lowers edge flows and keeps flow conservation, so the congestion does not increase.
+    """
+    unvisited, active, finished = 0, 1, 2
+    state = [unvisited] * graph.num_nodes
+    depth = [0] * graph.num_nodes
+
+    for root in range(graph.num_nodes):
+        if state[root] != unvisited:
+            continue
+
+        state[root] = active
+        depth[root] = 0
+        path = [root]
+        pending = [iter(list(graph.neighbors[root]))]
+        while path:
+            node = path[-1]
+            for nb in pending[-1]:
+                if nb not in graph.neighbors[node]:
+                    # deleted by a cancellation
+                    continue
+                if state[nb] == unvisited:
+                    state[nb] = active
+                    depth[nb] = len(path)
+                    path.append(nb)
+                    pending.append(iter(list(graph.neighbors[nb])))
+                    break
+                if state[nb] == active:
+                    tail = depth[nb] + _cancel_cycle(graph, path[depth[nb]:])
+                    for v in path[tail + 1:]:
+                        state[v] = unvisited
+                    del path[tail + 1:]
+                    del pending[tail + 1:]
+                    break
+            else:
+                state[node] = finished
+                path.pop()
+                pending.pop()
 
 
 def add_path_to_DAG(dag: DAG, path: str, val: float):
@@ -101,71 +105,182 @@ def add_path_to_DAG(dag: DAG, path: str, val: float):
         dag.neighbors[from_id][to_id] += val
 
 
-def calculate_optimal_solution(instance: Instance):
+PATH_FORMULATION = "path"
+ARC_FORMULATION = "arc"
+CROSS_CHECK_FORMULATIONS = "cross_check"
+
+# instances above this size are only solved with the arc formulation in cross-check mode
+CROSS_CHECK_MAX_NODES = 12
+CROSS_CHECK_TOLERANCE = 1e-6
+
+
+# LP values below this are solver noise and do not become edges of the optimal DAG
+FLOW_EPSILON = 1e-9
+
+
+def _build_path_formulation(instance: Instance):
     dag: DAG = instance.dag
     sources = instance.sources
     target = instance.target
     demands = instance.demands
 
-    try:
-        # print("..Setup Model")
-        # Create a new model
-        m = gp.Model("ecmp_opt")
-        m.setParam("OutputFlag", 0)
-
-        """ Add Variables """
-        # Congestion variable
-        cong = m.addVar(name="cong", obj=1.0, lb=0, ub=GRB.INFINITY, vtype=GRB.CONTINUOUS, column=None)
-
-        # Add a variable for each source -> target path, for each source
-        path_vars = dict()
-        edge_dict = defaultdict(list)
-        for s in sources:
-            path_vars[s] = list()
-            for p in generate_all_paths(dag, s, target, edge_dict):
-                path_vars[s].append(
-                    m.addVar(name=p, obj=0.0, lb=0, ub=GRB.INFINITY, vtype=GRB.CONTINUOUS, column=None)
-                )
-
-        """ Set Objective """
-        m.setObjective(cong, GRB.MINIMIZE)
-
-        """ Add constraints """
-        for i, s in enumerate(sources):
-            m.addConstr(sum(path_vars[s]) >= demands[i], name=f"source:{s}")
-
-        m.update()  # necessary to ensure we can access the variables by name below!
-        for k, v in edge_dict.items():
-            m.addConstr(sum([m.getVarByName(f"{name}") for name in v]) <= cong, name=f"edge:{k}")
-
-        """ Optimize """
-        # print("..Solve")
-        m.optimize()
-
-        if m.status == GRB.INFEASIBLE:
-            return None
-
-        """ Output solution """
-        # print("..Construct Solution")
+    lp = LinearProgram()
+
+    """ Add Variables """
+    # Congestion variable, the objective
+    cong = lp.add_variable("cong", obj=1.0)
+
+    # Add a variable for each source -> target path, for each source
+    path_vars = dict()
+    edge_dict = defaultdict(list)
+    for s in sources:
+        path_vars[s] = list()
+        for p in generate_all_paths(dag, s, target, edge_dict):
+            path_vars[s].append(lp.add_variable(p))
+
+    """ Add constraints """
+    for i, s in enumerate(sources):
+        lp.add_constraint({var: 1.0 for var in path_vars[s]}, ">=", demands[i])
+
+    var_index = {name: i for i, name in enumerate(lp.names)}
+    for k, v in edge_dict.items():
+        coefficients = {var_index[name]: 1.0 for name in v}
+        coefficients[cong] = -1.0
+        lp.add_constraint(coefficients, "<=", 0)
+
+    def to_dag(values):
         solution_dag = DAG(dag.num_nodes, defaultdict(lambda: defaultdict(float)))
-        opt_cong = m.ObjVal
-        for v in m.getVars():
-            if v.VarName != "cong":
-                if v.X > 0:
-                    add_path_to_DAG(solution_dag, v.VarName, v.X)
+        for name, val in zip(lp.names, values):
+            if name != "cong" and val > FLOW_EPSILON:
+                add_path_to_DAG(solution_dag, name, val)
+        return solution_dag
 
-        m.dispose()
+    return lp, to_dag
 
+
+def _build_arc_formulation(instance: Instance):
+    dag: DAG = instance.dag
+    target = instance.target
+
+    supply = [0] * dag.num_nodes
+    for s, d in zip(instance.sources, instance.demands):
+        supply[s] += d
+
+    lp = LinearProgram()
+
+    """ Add Variables """
+    # Congestion variable, the objective
+    cong = lp.add_variable("cong", obj=1.0)
+
+    # Add a flow variable for each edge, edges leaving the target never carry flow
+    edge_vars = dict()
+    for node in range(dag.num_nodes):
+        if node == target:
+            continue
+        for nb in dag.neighbors[node]:
+            edge_vars[(node, nb)] = lp.add_variable(f"edge:{node}-{nb}")
+
+    """ Add constraints """
+    outgoing = defaultdict(list)
+    incoming = defaultdict(list)
+    for (node, nb), var in edge_vars.items():
+        outgoing[node].append(var)
+        incoming[nb].append(var)
+        lp.add_constraint({var: 1.0, cong: -1.0}, "<=", 0)
+
+    # flow conservation, the target absorbs all demand
+    for node in range(dag.num_nodes):
+        if node != target:
+            coefficients = {var: 1.0 for var in outgoing[node]}
+            coefficients.update({var: -1.0 for var in incoming[node]})
+            lp.add_constraint(coefficients, "==", supply[node])
+
+    def to_dag(values):
+        solution_dag = DAG(dag.num_nodes, defaultdict(lambda: defaultdict(float)))
+        for (node, nb), var in edge_vars.items():
+            if values[var] > FLOW_EPSILON:
+                solution_dag.neighbors[node][nb] += values[var]
+        return solution_dag
+
+    return lp, to_dag
+
+
+def _solve_lp(instance: Instance, formulation: str, backend: str):
+    """
+        Returns:
+                The optimal flow, which may still contain cycles, and the optimal congestion or None if the instance
+                is infeasible
+    """
+    if formulation == PATH_FORMULATION:
+        build_formulation = _build_path_formulation
+    elif formulation == ARC_FORMULATION:
+        build_formulation = _build_arc_formulation
+    else:
+        raise RuntimeError(f"Invalid value for formulation: {formulation}")
+
+    metrics = get_metrics()
+    with metrics.time_stage("lp", nodes=instance.dag.num_nodes):
+        lp, to_dag = build_formulation(instance)
+        result = get_backend(backend).solve(lp)
+
+    metrics.observe("lp_variables", lp.num_vars, formulation=formulation)
+    if formulation == PATH_FORMULATION:
+        metrics.observe("lp_paths", sum(name.startswith("path:") for name in lp.names))
+
+    if result is None:
+        return None
+
+    return to_dag(result.values), result.objective
+
+
+def _solve(instance: Instance, formulation: str, backend: str, cancel_cycles=True):
+    lp_solution = _solve_lp(instance, formulation, backend)
+    if lp_solution is None:
+        return None
+
+    solution_dag, objective = lp_solution
+    if not cancel_cycles:
+        return Solution(solution_dag, objective)
+    with get_metrics().time_stage("remove_cycles", nodes=instance.dag.num_nodes):
         remove_cycles(solution_dag)
 
-        solution = Solution(solution_dag, opt_cong)
+    # every sub-DAG evaluation and conjecture check on this solution reuses its order
+    return Solution(with_topological_order(solution_dag), objective)
+
+
+def _cross_check(instance: Instance, backend: str, cancel_cycles=True):
+    arc_solution = _solve(instance, ARC_FORMULATION, backend, cancel_cycles)
+    if instance.dag.num_nodes > CROSS_CHECK_MAX_NODES:
+        return arc_solution
+
+    path_solution = _solve(instance, PATH_FORMULATION, backend, cancel_cycles)
+    if (arc_solution is None) != (path_solution is None):
+        raise RuntimeError("Path and arc formulation disagree on the feasibility of the instance.")
+
+    if arc_solution is not None and \
+            abs(arc_solution.opt_congestion - path_solution.opt_congestion) > CROSS_CHECK_TOLERANCE:
+        raise RuntimeError(f"Path and arc formulation disagree on the optimal congestion: "
+                           f"{path_solution.opt_congestion} (path) vs. {arc_solution.opt_congestion} (arc)")
+
+    return path_solution
 
-        return solution
 
-    except gp.GurobiError as e:
-        print('Error code ' + str(e.message) + ': ' + str(e))
+def calculate_optimal_solution(instance: Instance, formulation=PATH_FORMULATION, backend=DEFAULT_BACKEND,
+                               cancel_cycles=True):
+    """
+        Parameters:
+                instance (Instance): The routing instance to solve
+                formulation ("path" | "arc" | "cross_check"): the LP to solve. The path formulation has a
+                    variable per source -> target path, the arc formulation a variable per edge.
+                    "cross_check" solves both on small instances and raises if their optima differ.
+                backend ("highs" | "gurobi"): the LP solver, see lp_backends.py
+                cancel_cycles (bool): remove the cycles of the LP flow (see remove_cycles). Without, the raw LP flow
+                    is returned, it may contain cycles and has no topological order.
 
-    # except AttributeError:
-    #     print('Encountered an attribute error')
+        Returns:
+                The optimal (acyclic) flow and its congestion or None if the instance is infeasible
+    """
+    if formulation == CROSS_CHECK_FORMULATIONS:
+        return _cross_check(instance, backend, cancel_cycles)
 
-    return None
+    return _solve(instance, formulation, backend, cancel_cycles)
@@ -0,0 +1,136 @@
+import glob
+import multiprocessing
+import os
+import pickle
+
+from model import *
+
+GRAPH_JOB = "graph"
+PICKLE_JOB = "pickle"
+TEXT_JOB = "text"
+
+_writer = None
+# whether submit renders graphs when no OutputWriter is open, see set_render_graphs
+_render_graphs = True
+
+
+def unique_name(name: str) -> str:
+    """ Appends the name of the current process, so workers never write to the same file """
+    return f"{name}_{multiprocessing.current_process().name}"
+
+
+def _write_atomically(path: str, data, mode="w"):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", mode) as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def set_render_graphs(render: bool):
+    global _render_graphs
+    _render_graphs = render
+
+
+def _handle(kind: str, name: str, payload, render: bool):
+    if kind == GRAPH_JOB:
+        _write_atomically(f"output/{name}.dot", payload)
+        if render:
+            try:
+                _render(f"output/{name}.dot")
+            except Exception as e:
+                # the DOT source is stored, render_pending can try again
+                get_logger().error(f"Rendering {name} failed: {e!r}")
+    elif kind == PICKLE_JOB:
+        _write_atomically(f"output/{name}.pickle", payload, "wb")
+    elif kind == TEXT_JOB:
+        _write_atomically(f"output/{name}", payload)
+    else:
+        raise RuntimeError(f"Invalid output job: {kind}")
+
+
+def _writer_loop(queue, stop, render: bool):
+    while True:
+        if queue.empty():
+            # everything sent before stop was set is already in the pipe
+            if stop.is_set():
+                return
+            stop.wait(0.05)
+            continue
+
+        job = queue.get()
+        try:
+            _handle(*job, render)
+        except Exception as e:
+            # a failed render must not lose the other outputs
+            print(f"Output writer failed on {job[1]}: {e!r}")
+
+
+class OutputWriter:
+    """
+        A background process that writes pickles and failure reports and renders graphs, so workers never wait
+        for Graphviz or the disk. Workers hand over finished DOT sources and pickled bytes through a pipe, which
+        keeps every job even if the worker is terminated right afterwards.
+        With render=False only the DOT sources are stored, render them later with render_pending().
+        Processes forked while the writer is open send their outputs to it (see submit).
+    """
+
+    def __init__(self, render=True):
+        ctx = multiprocessing.get_context("fork")
+        self.render = render
+        self.queue = ctx.SimpleQueue()
+        # a stop event instead of a sentinel job, since a terminated worker may still hold the lock of the queue
+        self.stop = ctx.Event()
+        self.process = ctx.Process(target=_writer_loop, args=(self.queue, self.stop, render), name="OutputWriter",
+                                   daemon=True)
+
+    def __enter__(self):
+        global _writer
+        self.process.start()
+        _writer = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _writer
+        _writer = None
+        self.stop.set()
+        self.process.join()
+
+
+def submit(kind: str, name: str, payload):
+    """ Hands the job to the open OutputWriter, or does it right away if there is none """
+    if _writer is not None:
+        _writer.queue.put((kind, name, payload))
+    else:
+        _handle(kind, name, payload, _render_graphs)
+
+
+def write_graph(instance: Instance, name: str, solution: DAG = None):
+    """ Background version of show_graph, the DOT source is still built by the caller """
+    submit(GRAPH_JOB, name, instance_to_dot(instance, solution))
+
+
+def write_pickle(name: str, obj):
+    submit(PICKLE_JOB, name, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+
+def write_text(name: str, content: str):
+    submit(TEXT_JOB, name, content)
+
+
+def _render(dot_path: str):
+    graphviz.render("circo", "svg", dot_path, outfile=dot_path[:-len(".dot")] + ".svg")
+
+
+def render_pending(directory="output"):
+    """
+        Renders every DOT file below directory that has no SVG yet.
+
+        Returns:
+                The number of rendered graphs
+    """
+    count = 0
+    for path in glob.glob(os.path.join(directory, "**", "*.dot"), recursive=True):
+        if not os.path.exists(path[:-len(".dot")] + ".svg"):
+            _render(path)
+            count += 1
+    return count
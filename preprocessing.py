@@ -0,0 +1,211 @@
+from collections import deque
+
+from model import *
+from optimal_solver import calculate_optimal_solution, PATH_FORMULATION
+from lp_backends import DEFAULT_BACKEND
+
+# instance: the reduced instance with target 0, original_ids: the original id of every reduced node,
+# chains: the original ids of the contracted nodes on every contracted edge, in reduced ids.
+# If some sources cannot reach the target, the instance is infeasible and instance is None.
+Reduction = namedtuple("Reduction", "instance, original_ids, chains, unreachable_sources")
+
+
+def _reaching_target(inst: Instance):
+    incoming = defaultdict(list)
+    for node in range(inst.dag.num_nodes):
+        for nb in inst.dag.neighbors[node]:
+            incoming[nb].append(node)
+
+    reaching = {inst.target}
+    queue = deque([inst.target])
+    while queue:
+        node = queue.popleft()
+        for pred in incoming[node]:
+            if pred not in reaching:
+                reaching.add(pred)
+                queue.append(pred)
+    return reaching
+
+
+def _reachable_from_sources(inst: Instance, allowed: set):
+    reachable = set(inst.sources)
+    queue = deque(inst.sources)
+    while queue:
+        node = queue.popleft()
+        if node == inst.target:
+            continue
+        for nb in inst.dag.neighbors[node]:
+            if nb in allowed and nb not in reachable:
+                reachable.add(nb)
+                queue.append(nb)
+    return reachable
+
+
+def _contract_chains(out_nbs: dict, in_nbs: dict, keep: set):
+    """
+        Replaces u -> v -> w by u -> w for every node v outside of keep with a single in- and out-edge, in place.
+        Chains are contracted node by node. A contraction that would create a loop or a parallel edge is skipped.
+
+        Returns:
+                The contracted nodes of every new edge, in path order
+    """
+    chains = dict()
+    for v in list(out_nbs):
+        if v in keep or len(out_nbs[v]) != 1 or len(in_nbs[v]) != 1:
+            continue
+        (u,), (w,) = in_nbs[v], out_nbs[v]
+        if u == w or w in out_nbs[u]:
+            continue
+
+        out_nbs[u].remove(v)
+        out_nbs[u].add(w)
+        in_nbs[w].remove(v)
+        in_nbs[w].add(u)
+        chains[(u, w)] = chains.pop((u, v), ()) + (v,) + chains.pop((v, w), ())
+        del out_nbs[v], in_nbs[v]
+    return chains
+
+
+def reduce_instance(inst: Instance, contract_chains=True) -> Reduction:
+    """
+        Removes everything that cannot carry flow: nodes that cannot reach the target or that no source reaches,
+        and the edges leaving the target. With contract_chains, nodes that are neither source nor target and have
+        a single in- and out-edge are contracted, which keeps the flow and the load of every remaining edge.
+        The remaining nodes are renumbered, the target becomes node 0 and the others keep their relative order.
+        All of it takes O(|V| + |E|).
+
+        Returns:
+                The Reduction, see above
+    """
+    reaching = _reaching_target(inst)
+    unreachable_sources = [s for s in inst.sources if s not in reaching]
+    if unreachable_sources:
+        return Reduction(None, None, None, unreachable_sources)
+
+    used = _reachable_from_sources(inst, reaching) | {inst.target}
+    out_nbs = {node: set() for node in used}
+    in_nbs = {node: set() for node in used}
+    for node in used:
+        if node == inst.target:
+            continue
+        for nb in inst.dag.neighbors[node]:
+            if nb in used:
+                out_nbs[node].add(nb)
+                in_nbs[nb].add(node)
+
+    chains = dict()
+    if contract_chains:
+        chains = _contract_chains(out_nbs, in_nbs, set(inst.sources) | {inst.target})
+
+    original_ids = [inst.target] + sorted(node for node in out_nbs if node != inst.target)
+    new_id = {node: i for i, node in enumerate(original_ids)}
+
+    edges = defaultdict(list)
+    for node in original_ids:
+        edges[new_id[node]] = sorted(new_id[nb] for nb in out_nbs[node])
+    reduced_chains = {(new_id[u], new_id[w]): path for (u, w), path in chains.items()}
+
+    reduced = Instance(DAG(len(original_ids), edges), [new_id[s] for s in inst.sources], 0, list(inst.demands))
+    return Reduction(reduced, original_ids, reduced_chains, [])
+
+
+def split_instance(inst: Instance):
+    """
+        Splits the instance into the parts that only share the target, flows in different parts never meet.
+        Every part is renumbered with target 0 like a reduced instance.
+
+        Returns:
+                The list of (part, original ids of its nodes)
+    """
+    n = inst.dag.num_nodes
+    adjacency = [[] for _ in range(n)]
+    for node in range(n):
+        for nb in inst.dag.neighbors[node]:
+            if node != inst.target and nb != inst.target:
+                adjacency[node].append(nb)
+                adjacency[nb].append(node)
+
+    component = [None] * n
+    parts = []
+    for start in range(n):
+        if start == inst.target or component[start] is not None:
+            continue
+        component[start] = len(parts)
+        nodes = [start]
+        queue = deque([start])
+        while queue:
+            node = queue.popleft()
+            for nb in adjacency[node]:
+                if component[nb] is None:
+                    component[nb] = len(parts)
+                    nodes.append(nb)
+                    queue.append(nb)
+        parts.append(sorted(nodes))
+
+    if len(parts) <= 1:
+        return [(inst, list(range(n)))]
+
+    result = []
+    for i, nodes in enumerate(parts):
+        original_ids = [inst.target] + nodes
+        new_id = {node: j for j, node in enumerate(original_ids)}
+        edges = defaultdict(list)
+        for node in nodes:
+            edges[new_id[node]] = [new_id[nb] for nb in inst.dag.neighbors[node]]
+        sources, demands = [], []
+        for s, d in zip(inst.sources, inst.demands):
+            if component[s] == i:
+                sources.append(new_id[s])
+                demands.append(d)
+        result.append((Instance(DAG(len(original_ids), edges), sources, 0, demands), original_ids))
+    return result
+
+
+def expand_solution(reduction: Reduction, num_nodes: int, flows: dict) -> DAG:
+    """
+        Maps a flow on the reduced instance back to the original node ids, the flow of a contracted edge is put on
+        every edge of its chain.
+
+        Parameters:
+                reduction (Reduction): The reduction the flow was computed on
+                num_nodes (int): The number of nodes of the original instance
+                flows (dict): flows[u][w] is the flow on the reduced edge u -> w
+
+        Returns:
+                The flow DAG in original node ids
+    """
+    original = reduction.original_ids
+    expanded = DAG(num_nodes, defaultdict(lambda: defaultdict(float)))
+    for u in list(flows):
+        for w, value in flows[u].items():
+            path = (original[u],) + reduction.chains.get((u, w), ()) + (original[w],)
+            for start, end in zip(path, path[1:]):
+                expanded.neighbors[start][end] += value
+    return expanded
+
+
+def calculate_reduced_solution(inst: Instance, reduction: Reduction, formulation=PATH_FORMULATION,
+                               backend=DEFAULT_BACKEND):
+    """
+        Solves every part of the reduced instance on its own (see calculate_optimal_solution) and combines them.
+        The optimal congestion is the largest one of the parts.
+
+        Returns:
+                The optimal flow in original node ids and its congestion or None if the instance is infeasible
+    """
+    if reduction.unreachable_sources:
+        return None
+
+    flows = defaultdict(dict)
+    congestion = 0
+    for part, part_ids in split_instance(reduction.instance):
+        solution = calculate_optimal_solution(part, formulation, backend)
+        if solution is None:
+            return None
+        congestion = max(congestion, solution.opt_congestion)
+        for node in list(solution.dag.neighbors):
+            for nb, value in solution.dag.neighbors[node].items():
+                flows[part_ids[node]][part_ids[nb]] = value
+
+    # the parts only share the target, which has no outgoing flow, so the combined flow stays acyclic
+    return Solution(with_topological_order(expand_solution(reduction, inst.dag.num_nodes, flows)), congestion)
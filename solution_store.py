@@ -0,0 +1,142 @@
+import os
+import pickle
+import sqlite3
+import time
+
+from canonical import instance_hash
+from model import *
+
+DEFAULT_STORE_PATH = "output/solutions.sqlite"
+
+
+def _dump_dag(dag):
+    # the nested defaultdict of a flow DAG holds a lambda and cannot be pickled directly
+    return dag.num_nodes, {node: dict(dag.neighbors[node]) for node in range(dag.num_nodes) if dag.neighbors[node]}
+
+
+def _load_dag(data) -> DAG:
+    num_nodes, neighbors = data
+    dag = DAG(num_nodes, defaultdict(lambda: defaultdict(float)))
+    for node, nbs in neighbors.items():
+        dag.neighbors[node].update(nbs)
+    return dag
+
+
+def _dump_solution(solution: Solution):
+    return pickle.dumps((_dump_dag(solution.dag), solution.opt_congestion), pickle.HIGHEST_PROTOCOL)
+
+
+def _load_solution(data: bytes) -> Solution:
+    dag, opt_congestion = pickle.loads(data)
+    return Solution(with_topological_order(_load_dag(dag)), opt_congestion)
+
+
+def _dump_ecmp_solutions(ecmp_solutions: list[ECMP_Sol]):
+    return pickle.dumps(
+        [(_dump_dag(sol.dag), sol.congestion, list(sol.loads)) for sol in ecmp_solutions], pickle.HIGHEST_PROTOCOL
+    )
+
+
+def _load_ecmp_solutions(data: bytes) -> list[ECMP_Sol]:
+    return [
+        ECMP_Sol(with_topological_order(_load_dag(dag)), congestion, loads)
+        for dag, congestion, loads in pickle.loads(data)
+    ]
+
+
+class SolutionStore:
+    """
+        An SQLite file of solved instances and their optimal solutions (None for infeasible instances), keyed by the
+        canonical hash of the labelled instance. The optimal ECMP sub-DAGs of a solution can be stored alongside.
+        Every process opens its own connection, the database runs in WAL mode and waits for locks, so many workers
+        can read and write the same store concurrently.
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self._connection = None
+        self._pid = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS solutions ("
+            "hash TEXT PRIMARY KEY, instance BLOB, solution BLOB, opt_congestion REAL, "
+            "formulation TEXT, backend TEXT, created REAL)"
+        )
+        self._connect().execute("CREATE TABLE IF NOT EXISTS ecmp_solutions (hash TEXT PRIMARY KEY, solutions BLOB)")
+
+    def _connect(self):
+        # sqlite connections must not be shared with forked processes
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._connection
+
+    def __getstate__(self):
+        return {"path": self.path, "_connection": None, "_pid": None}
+
+    def get(self, inst: Instance):
+        """
+            Returns:
+                    (True, solution) if the instance was solved before, where solution is None if it is infeasible.
+                    (False, None) otherwise.
+        """
+        row = self._connect().execute(
+            "SELECT solution FROM solutions WHERE hash = ?", (instance_hash(inst, up_to_isomorphism=False),)
+        ).fetchone()
+        if row is None:
+            return False, None
+        return True, _load_solution(row[0]) if row[0] is not None else None
+
+    def put(self, inst: Instance, solution: Solution, formulation: str = None, backend: str = None):
+        self._connect().execute(
+            "INSERT OR IGNORE INTO solutions VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                instance_hash(inst, up_to_isomorphism=False),
+                pickle.dumps(inst, pickle.HIGHEST_PROTOCOL),
+                _dump_solution(solution) if solution is not None else None,
+                solution.opt_congestion if solution is not None else None,
+                formulation,
+                backend,
+                time.time()
+            )
+        )
+
+    def get_ecmp_solutions(self, inst: Instance):
+        """
+            Returns:
+                    The stored optimal ECMP sub-DAGs of the instance or None
+        """
+        row = self._connect().execute(
+            "SELECT solutions FROM ecmp_solutions WHERE hash = ?", (instance_hash(inst, up_to_isomorphism=False),)
+        ).fetchone()
+        return _load_ecmp_solutions(row[0]) if row is not None else None
+
+    def put_ecmp_solutions(self, inst: Instance, ecmp_solutions: list[ECMP_Sol]):
+        self._connect().execute(
+            "INSERT OR IGNORE INTO ecmp_solutions VALUES (?, ?)",
+            (instance_hash(inst, up_to_isomorphism=False), _dump_ecmp_solutions(ecmp_solutions))
+        )
+
+    def iterate_instances(self, feasible_only=True):
+        """
+            Returns:
+                    Generator of (row id, instance) for all stored instances
+        """
+        query = "SELECT rowid, instance FROM solutions"
+        if feasible_only:
+            query += " WHERE solution IS NOT NULL"
+        for rowid, inst_data in self._connect().execute(query + " ORDER BY rowid"):
+            yield rowid, pickle.loads(inst_data)
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM solutions").fetchone()[0]
+
+    def __iter__(self):
+        """
+            Returns:
+                    Generator of all stored (instance, solution) pairs
+        """
+        rows = self._connect().execute("SELECT instance, solution FROM solutions ORDER BY rowid")
+        for inst_data, sol_data in rows:
+            yield pickle.loads(inst_data), _load_solution(sol_data) if sol_data is not None else None
@@ -0,0 +1,223 @@
+import glob
+import json
+import multiprocessing
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# upper bucket bounds for durations in seconds (half decades from 10us to 100s) and for sizes (powers of two)
+TIME_BUCKETS = tuple(round(10.0 ** (e / 2), 6) for e in range(-10, 5))
+SIZE_BUCKETS = tuple(2 ** e for e in range(21))
+
+DEFAULT_METRICS_DIR = "output/metrics"
+DEFAULT_EXPORT_INTERVAL = 5.0
+
+STAGE_SECONDS = "stage_seconds"
+
+
+class Histogram:
+    """ Counts of observed values per bucket, a value goes to the first bucket whose upper bound it does not exceed """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        if other.bounds != self.bounds:
+            raise RuntimeError("Cannot merge histograms with different buckets.")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float):
+        """
+            Returns:
+                    An upper estimate of the q-quantile: the upper bound of its bucket, but at most the maximum
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "bounds": list(self.bounds),
+            "counts": self.counts,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        histogram = cls(data["bounds"])
+        histogram.counts = list(data["counts"])
+        histogram.count = data["count"]
+        histogram.sum = data["sum"]
+        if histogram.count:
+            histogram.min, histogram.max = data["min"], data["max"]
+        return histogram
+
+
+def _format_labels(labels: tuple, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+class MetricsRegistry:
+    """
+        The histograms of one process, keyed by metric name and labels. export() writes them to
+        <directory>/<name>.json and, in the Prometheus text exposition format, to <directory>/<name>.prom.
+    """
+
+    def __init__(self, name: str, directory=DEFAULT_METRICS_DIR, export_interval=DEFAULT_EXPORT_INTERVAL):
+        self.name = name
+        self.directory = directory
+        self.export_interval = export_interval
+        self.histograms = dict()
+        self.last_export = time.time()
+
+    def observe(self, metric: str, value: float, buckets=SIZE_BUCKETS, **labels):
+        key = (metric, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        self.histograms[key].observe(value)
+
+    def observe_stage(self, stage: str, seconds: float, **labels):
+        self.observe(STAGE_SECONDS, seconds, TIME_BUCKETS, stage=stage, **labels)
+
+    @contextmanager
+    def time_stage(self, stage: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start, **labels)
+
+    def merge(self, other):
+        for key, histogram in other.histograms.items():
+            if key in self.histograms:
+                self.histograms[key].merge(histogram)
+            else:
+                self.histograms[key] = Histogram.from_dict(histogram.to_dict())
+
+    def to_dict(self):
+        return {
+            "process": self.name,
+            "updated": time.time(),
+            "histograms": [
+                {"name": metric, "labels": dict(labels), **histogram.to_dict()}
+                for (metric, labels), histogram in sorted(self.histograms.items())
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict, directory=DEFAULT_METRICS_DIR):
+        registry = cls(data["process"], directory)
+        for entry in data["histograms"]:
+            key = (entry["name"], tuple(sorted(entry["labels"].items())))
+            registry.histograms[key] = Histogram.from_dict(entry)
+        return registry
+
+    def to_text(self):
+        lines = []
+        last_metric = None
+        for (metric, labels), histogram in sorted(self.histograms.items()):
+            if metric != last_metric:
+                lines.append(f"# TYPE {metric} histogram")
+                last_metric = metric
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                lines.append(f"{metric}_bucket{_format_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, le='+Inf')} {histogram.count}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, self.name)
+        # write to a temporary file first, so readers never see a partial file
+        for suffix, content in ((".json", json.dumps(self.to_dict())), (".prom", self.to_text())):
+            with open(path + suffix + ".tmp", "w") as f:
+                f.write(content)
+            os.replace(path + suffix + ".tmp", path + suffix)
+        self.last_export = time.time()
+
+    def maybe_export(self):
+        """ Exports the histograms if the last export is more than export_interval seconds ago """
+        if time.time() - self.last_export >= self.export_interval:
+            self.export()
+
+    def stage_summary(self):
+        """
+            Returns:
+                    Lines with the total, mean and median time of every stage, over all labels
+        """
+        stages = dict()
+        for (metric, labels), histogram in self.histograms.items():
+            if metric != STAGE_SECONDS:
+                continue
+            stage = dict(labels)["stage"]
+            if stage not in stages:
+                stages[stage] = Histogram(histogram.bounds)
+            stages[stage].merge(histogram)
+
+        return [
+            f"{stage:<24} {h.sum:>9.2f}s total {h.sum / h.count * 1000:>9.2f}ms mean "
+            f"<={h.quantile(0.5) * 1000:>9.2f}ms median ({h.count} times)"
+            for stage, h in sorted(stages.items(), key=lambda item: -item[1].sum)
+        ]
+
+
+_registries = dict()
+
+
+def get_metrics() -> MetricsRegistry:
+    """ Returns the registry of the current process, named after the process """
+    pid = os.getpid()
+    if pid not in _registries:
+        _registries[pid] = MetricsRegistry(multiprocessing.current_process().name)
+    return _registries[pid]
+
+
+def read_metrics(directory=DEFAULT_METRICS_DIR, name="all") -> MetricsRegistry:
+    """
+        Returns:
+                A registry with the merged histograms of all processes that exported to directory
+    """
+    merged = MetricsRegistry(name, directory)
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        if os.path.basename(path) == f"{name}.json":
+            continue
+        with open(path) as f:
+            merged.merge(MetricsRegistry.from_dict(json.load(f), directory))
+    return merged
+
+
+def clear_metrics(directory=DEFAULT_METRICS_DIR):
+    for path in glob.glob(os.path.join(directory, "*.json")) + glob.glob(os.path.join(directory, "*.prom")):
+        os.remove(path)
@@ -0,0 +1,40 @@
+import glob
+import os
+import threading
+
+from conjectures import Conjecture
+from distributed import Coordinator, start_local_workers
+from main import ConjectureManager, InstanceGenerator, CHECK_ON_OPTIMAL_SUB_DAGS_ONLY, ECMP_FORWARDING
+
+ALWAYS_FAILS = Conjecture("always_fails", lambda context: False, lambda context: "fails on purpose")
+
+
+def test_worker_counterexamples_are_counted_and_stored(tmp_path, monkeypatch):
+    # every output path is relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ConjectureManager, "conjectures_to_check", [ALWAYS_FAILS])
+    ConjectureManager.setup(CHECK_ON_OPTIMAL_SUB_DAGS_ONLY, ECMP_FORWARDING, exit_on_counterexample=False,
+                            render_graphs=False)
+
+    key = b"test"
+    coordinator = Coordinator(InstanceGenerator(6, True, seed=1), 4, key, ("localhost", 0), chunk_size=2,
+                              heartbeat_timeout=10)
+    thread = threading.Thread(target=coordinator.run)
+    thread.start()
+    assert coordinator.listening.wait(10)
+
+    workers = start_local_workers(coordinator.address, key, 2, heartbeat_interval=0.5)
+    thread.join(60)
+    for worker in workers:
+        worker.join(10)
+
+    assert not thread.is_alive()
+    statistics = coordinator.statistics
+    assert statistics.num_instances == 4
+    assert statistics.num_errors == 0
+    # infeasible instances satisfy every conjecture, the seed gives feasible ones as well
+    assert statistics.counterexamples
+    for index in statistics.counterexamples:
+        assert os.path.exists(f"output/distributed/ex_{index}.pickle")
+        assert glob.glob(f"output/errors_always_fails/ex_{index}_*.pickle")
+        assert glob.glob(f"output/errors_always_fails/ex_{index}_*_fail.txt")
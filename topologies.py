@@ -0,0 +1,154 @@
+import random
+from collections import deque
+
+from model import *
+
+# a topology is an undirected network, endpoints are the switches that send and receive traffic
+Topology = namedtuple("Topology", "name, num_nodes, links, endpoints")
+
+# only the links that lie on a shortest path to the target, oriented towards it, as routed by ECMP
+SHORTEST_PATHS = "shortest_paths"
+# both directions of every link, the optimal solution may use any of them
+BIDIRECTED = "bidirected"
+
+
+def fat_tree(k: int) -> Topology:
+    """
+        The k-ary fat-tree of Al-Fares et al. on switch level: (k/2)^2 core switches and k pods of k/2 aggregation
+        and k/2 edge switches each. The edge switches are the endpoints.
+        Nodes are numbered core switches first, then pod by pod the aggregation and the edge switches.
+    """
+    if k < 2 or k % 2 != 0:
+        raise RuntimeError("The fat-tree parameter k must be even and at least 2.")
+    half = k // 2
+    num_core = half * half
+    links = []
+    endpoints = []
+    for pod in range(k):
+        aggregation = num_core + pod * k
+        edge = aggregation + half
+        for j in range(half):
+            links.extend((aggregation + j, core) for core in range(j * half, (j + 1) * half))
+            links.extend((aggregation + j, edge + e) for e in range(half))
+        endpoints.extend(range(edge, edge + half))
+    return Topology(f"fat_tree_{k}", num_core + k * k, links, endpoints)
+
+
+def leaf_spine(num_leaves: int, num_spines: int) -> Topology:
+    """ A two-tier Clos fabric, every leaf is linked to every spine. Spines come first, the leaves are the endpoints """
+    if num_leaves < 2 or num_spines < 1:
+        raise RuntimeError("A leaf-spine fabric needs at least 2 leaves and 1 spine.")
+    links = [(num_spines + leaf, spine) for leaf in range(num_leaves) for spine in range(num_spines)]
+    return Topology(f"leaf_spine_{num_leaves}x{num_spines}", num_spines + num_leaves, links,
+                    list(range(num_spines, num_spines + num_leaves)))
+
+
+def ring(num_nodes: int) -> Topology:
+    if num_nodes < 3:
+        raise RuntimeError("A ring needs at least 3 nodes.")
+    links = [(node, (node + 1) % num_nodes) for node in range(num_nodes)]
+    return Topology(f"ring_{num_nodes}", num_nodes, links, list(range(num_nodes)))
+
+
+def grid(rows: int, columns: int, torus=False) -> Topology:
+    """ A rows x columns grid with node r * columns + c in row r and column c, with torus the borders wrap around """
+    if rows < 1 or columns < 1 or rows * columns < 3:
+        raise RuntimeError("A grid needs at least 3 nodes.")
+    if torus and (rows < 3 or columns < 3):
+        raise RuntimeError("A torus needs at least 3 rows and 3 columns.")
+    links = []
+    for r in range(rows):
+        for c in range(columns):
+            node = r * columns + c
+            if c + 1 < columns or torus:
+                links.append((node, r * columns + (c + 1) % columns))
+            if r + 1 < rows or torus:
+                links.append((node, (r + 1) % rows * columns + c))
+    name = f"{'torus' if torus else 'grid'}_{rows}x{columns}"
+    return Topology(name, rows * columns, links, list(range(rows * columns)))
+
+
+def _distances_to(num_nodes: int, adjacency: list, target: int):
+    """
+        Returns:
+                The hop distance of every node to target (None if unreachable) and the nodes in BFS order
+    """
+    distance = [None] * num_nodes
+    distance[target] = 0
+    visited = [target]
+    queue = deque(visited)
+    while queue:
+        node = queue.popleft()
+        for nb in adjacency[node]:
+            if distance[nb] is None:
+                distance[nb] = distance[node] + 1
+                visited.append(nb)
+                queue.append(nb)
+    return distance, visited
+
+
+def orient(topology: Topology, target: int, orientation=SHORTEST_PATHS) -> DAG:
+    """
+        Turns the links of the topology into directed edges in O(|V| + |E|).
+        With SHORTEST_PATHS the result is acyclic and comes with its topological order.
+    """
+    if not 0 <= target < topology.num_nodes:
+        raise RuntimeError(f"Invalid target {target} for {topology.name}.")
+    edges = defaultdict(list)
+    if orientation == BIDIRECTED:
+        for u, v in topology.links:
+            edges[u].append(v)
+            edges[v].append(u)
+        return DAG(topology.num_nodes, edges)
+    if orientation != SHORTEST_PATHS:
+        raise RuntimeError(f"Invalid orientation: {orientation}")
+
+    adjacency = [[] for _ in range(topology.num_nodes)]
+    for u, v in topology.links:
+        adjacency[u].append(v)
+        adjacency[v].append(u)
+    distance, visited = _distances_to(topology.num_nodes, adjacency, target)
+
+    for u, v in topology.links:
+        if distance[u] is None or distance[v] is None:
+            continue
+        if distance[u] == distance[v] + 1:
+            edges[u].append(v)
+        elif distance[v] == distance[u] + 1:
+            edges[v].append(u)
+
+    # edges lead from distance d to d - 1, so decreasing distance is a topological order
+    unreachable = [node for node in range(topology.num_nodes) if distance[node] is None]
+    return DAG(topology.num_nodes, edges, tuple(unreachable + visited[::-1]))
+
+
+def build_topology_instance(topology: Topology, rng=random, target=None, num_sources=None, arbitrary_demands=False,
+                            max_demand=None, orientation=SHORTEST_PATHS) -> Instance:
+    """
+        Samples traffic on the topology: a target and sources among the endpoints and their demands.
+
+        Parameters:
+                topology (Topology): The network
+                rng (random.Random): The source of randomness
+                target (int | None): The target node, a random endpoint if None
+                num_sources (int | None): The number of sources, from 2 to all other endpoints if None
+                arbitrary_demands (bool): Random demands from 1 to max_demand instead of unit demands
+                max_demand (int | None): The largest demand, the number of nodes if None
+                orientation (str): SHORTEST_PATHS or BIDIRECTED, see orient
+
+        Returns:
+                The instance on the oriented topology
+    """
+    target = rng.choice(topology.endpoints) if target is None else target
+    candidates = [node for node in topology.endpoints if node != target]
+    if num_sources is None:
+        num_sources = rng.randint(min(2, len(candidates)), len(candidates))
+    if not 1 <= num_sources <= len(candidates):
+        raise RuntimeError(f"{topology.name} has {len(candidates)} endpoints besides the target, "
+                           f"cannot choose {num_sources} sources.")
+
+    dag = orient(topology, target, orientation)
+    sources = rng.sample(candidates, num_sources)
+    max_demand = topology.num_nodes if max_demand is None else max_demand
+    demands = [rng.randint(1, max_demand) for _ in sources] if arbitrary_demands else [1] * len(sources)
+    return Instance(dag, sources, target, demands)